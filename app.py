@@ -1,26 +1,113 @@
+import json
+import time
+from collections import OrderedDict
+from datetime import date
 from flask import (
     Flask,
+    Response,
+    g,
     request,
+    _request_ctx_stack,
     abort,
-    jsonify
+    jsonify,
+    stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import OperationalError
+from werkzeug.http import parse_date as parse_http_date
 from flask_cors import CORS
 from auth import (
     AuthError,
-    requires_auth
+    requires_auth,
+    check_permissions,
+    get_auth_payload,
+    auth_cache
+)
+from idempotency import idempotent
+from timeouts import (
+    timeout_for,
+    is_statement_timeout
+)
+from ratelimit import (
+    rate_limit,
+    check_rate_limit,
+    limiter,
+    inflight
+)
+from serializers import render_list
+from singleflight import (
+    coalesce,
+    read_flights
+)
+from export import EXPORT_TABLES
+from jobs import (
+    JOB_KINDS,
+    parse_export,
+    import_file_name,
+    enqueue,
+    file_parts,
+    read_file
+)
+from compression import (
+    compress_response,
+    compressed_cache
 )
 from models import (
+    db,
     setup_db,
     # db_drop_and_create_all,
     Actor,
     Movie,
-    Performance
+    Performance,
+    existing_actor_ids,
+    cast_actors,
+    update_actor_fees,
+    uncast_actors,
+    movie_cast,
+    changes_since,
+    Job,
+    actor_cache,
+    movie_cache,
+    get_many_formatted,
+    movies_released,
+    release_calendar,
+    release_calendar_cache,
+    CALENDAR_GRANULARITIES
+)
+from config import (
+    PAGINATION,
+    CHANGES_PAGE_SIZE,
+    CHANGES_MAX_PAGE_SIZE,
+    CHANGE_STREAM_POLL_SECONDS,
+    CHANGE_STREAM_MAX_SECONDS,
+    BATCH_MAX_REQUESTS,
+    MULTI_GET_MAX_IDS,
+    UNIT_OF_WORK,
+    RELEASES_PAGE_SIZE,
+    RELEASES_MAX_PAGE_SIZE,
+    METRICS_PERMISSION
 )
-from config import PAGINATION
 
 ROWS_PER_PAGE = int(PAGINATION)
 
+# Endpoints that cannot run inside POST /batch: the batch endpoint itself and
+# streaming responses, which are unbounded.
+BATCH_EXCLUDED_ENDPOINTS = {'batch', 'stream_changes', 'get_job_file'}
+
+# Endpoints that are never shed by the in-flight request cap, so that load
+# can still be observed while the worker is saturated.
+ADMISSION_EXEMPT_ENDPOINTS = {'metrics'}
+INFLIGHT_ENVIRON_KEY = 'capstone.inflight'
+
+# Fields GET /actors and GET /movies can be ordered by with ?sort=<field>
+# (ascending) or ?sort=-<field> (descending).
+ACTOR_SORT_FIELDS = ('id', 'name', 'age', 'movie_count')
+MOVIE_SORT_FIELDS = ('id', 'title', 'release_date', 'cast_count', 'total_fee')
+
+# Sub-request headers POST /batch passes through; Authorization is not needed
+# because the batch token has already been verified.
+BATCH_FORWARDED_HEADERS = ('Accept', 'Idempotency-Key')
+
 
 def create_app(test_config=None):
     app = Flask(__name__)
@@ -29,6 +116,35 @@ def create_app(test_config=None):
 
     CORS(app)
 
+    @app.before_request
+    def admit_request():
+        if request.endpoint in ADMISSION_EXEMPT_ENDPOINTS:
+            return
+
+        slot = inflight.acquire()
+
+        if slot is None:
+            abort(503, {'message': 'server is busy, retry shortly.', 'retry_after': 1})
+
+        # Kept on the WSGI environ rather than on g: POST /batch pushes
+        # nested request contexts that share g but must not release the slot.
+        request.environ[INFLIGHT_ENVIRON_KEY] = slot
+
+    @app.before_request
+    def set_statement_timeout():
+        g.statement_timeout_ms = timeout_for(request.endpoint)
+
+    @app.before_request
+    def begin_unit_of_work():
+        g.unit_of_work = UNIT_OF_WORK
+
+    @app.teardown_request
+    def release_request(exception=None):
+        slot = request.environ.pop(INFLIGHT_ENVIRON_KEY, None)
+
+        if slot is not None:
+            inflight.release(slot)
+
     @app.after_request
     def after_request(response):
 
@@ -41,8 +157,29 @@ def create_app(test_config=None):
             'GET,PATCH,POST,DELETE,OPTIONS'
         )
 
+        return compress_response(request, response)
+
+    def end_unit_of_work(response):
+        '''Commits the request's writes, or rolls them back for an error response.'''
+        try:
+            if response.status_code >= 400:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except OperationalError as e:
+            return app.make_response(database_error(e))
+
+        # Reads arriving from now on must see this request's writes, so they
+        # may not join a coalesced read that started before them.
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            read_flights.forget()
+
         return response
 
+    # Registered after the hook above so that it runs first: a failed commit
+    # still gets the CORS headers and compression.
+    app.after_request(end_unit_of_work)
+
     def paginate_results(request, selection):
     
         page = request.args.get('page', 1, type=int)
@@ -54,6 +191,95 @@ def create_app(test_config=None):
         
         return objects_formatted[start:end]
 
+    def parse_id(raw):
+        try:
+            return int(raw)
+        except ValueError:
+            abort(404, {'message': '{} is not a valid id.'.format(raw)})
+
+    def parse_ids(raw):
+        # "1,2,3" from a query string, or [1, 2, 3] from a JSON body.
+        if isinstance(raw, str):
+            raw = [entity_id for entity_id in raw.split(',') if entity_id]
+
+        try:
+            return [int(entity_id) for entity_id in raw]
+        except (TypeError, ValueError):
+            abort(422, {'message': 'ids must be a list of integers.'})
+
+    def parse_release_date(raw):
+        # YYYY-MM-DD, or the HTTP date the API itself returns for release_date.
+        if isinstance(raw, str):
+            try:
+                return date.fromisoformat(raw)
+            except ValueError:
+                parsed = parse_http_date(raw)
+
+                if parsed is not None:
+                    return parsed.date()
+
+        abort(422, {'message': 'release_date must be a date (YYYY-MM-DD).'})
+
+    def parse_age(raw):
+        if isinstance(raw, bool) or not isinstance(raw, (int, str)):
+            abort(422, {'message': 'age must be a non-negative integer.'})
+
+        try:
+            age = int(raw)
+        except ValueError:
+            abort(422, {'message': 'age must be a non-negative integer.'})
+
+        if age < 0:
+            abort(422, {'message': 'age must be a non-negative integer.'})
+
+        return age
+
+    def sorted_query(model, sort_fields):
+        sort = request.args.get('sort')
+
+        if not sort:
+            return model.live()
+
+        field = sort.lstrip('-')
+
+        if field not in sort_fields:
+            abort(400, {'message': 'sort must be one of {}.'.format(', '.join(sort_fields))})
+
+        column = getattr(model, field)
+        return model.live().order_by(column.desc() if sort.startswith('-') else column.asc(), model.id)
+
+    def parse_date(name, default=None):
+        raw = request.args.get(name)
+
+        if raw is None:
+            return default
+
+        try:
+            return date.fromisoformat(raw)
+        except ValueError:
+            abort(400, {'message': '{} must be a date (YYYY-MM-DD).'.format(name)})
+
+    def parse_limit(default, maximum):
+        limit = request.args.get('limit', default, type=int)
+
+        if limit < 1:
+            abort(400, {'message': 'limit must be a positive integer.'})
+
+        return min(limit, maximum)
+
+    def multi_get(model, key, ids):
+        if len(ids) > MULTI_GET_MAX_IDS:
+            abort(422, {'message': 'at most {} ids per request.'.format(MULTI_GET_MAX_IDS)})
+
+        ids = list(OrderedDict.fromkeys(ids))
+        found = get_many_formatted(model, ids)
+
+        return render_list(
+            key,
+            [found[entity_id] for entity_id in ids if entity_id in found],
+            missing=[entity_id for entity_id in ids if entity_id not in found]
+        )
+
     # ---------------------------------------------------------------------------- #
     # API Endpoints																   #
     # ---------------------------------------------------------------------------- #
@@ -68,19 +294,69 @@ def create_app(test_config=None):
             "access_token": request.args.get("access_token")
             })
     
+    @app.route('/metrics', methods=['GET'])
+    @requires_auth(METRICS_PERMISSION)
+    def metrics(payload):
+        return jsonify({
+            'success': True,
+            'caches': {
+                'actors': actor_cache.stats(),
+                'movies': movie_cache.stats(),
+                'release_calendar': release_calendar_cache.stats(),
+                'auth': auth_cache.stats(),
+                'compressed_responses': compressed_cache.stats()
+            },
+            'rate_limits': limiter.stats(),
+            'inflight': inflight.stats(),
+            'coalesced_reads': read_flights.stats()
+        })
+
     @app.route('/actors', methods=['GET'])
     @requires_auth('read:actors')
+    @rate_limit('list')
+    @coalesce
     def get_actors(payload):
 
-        selection = Actor.query.all()
+        if 'ids' in request.args:
+            return multi_get(Actor, 'actors', parse_ids(request.args['ids']))
+
+        selection = sorted_query(Actor, ACTOR_SORT_FIELDS).all()
         actors_paginated = paginate_results(request, selection)
 
         if len(actors_paginated) == 0:
             abort(404, {'message': 'no actors found in database.'})
 
+        return render_list('actors', actors_paginated)
+
+    @app.route('/actors/lookup', methods=['POST'])
+    @requires_auth('read:actors')
+    @rate_limit('list')
+    def lookup_actors(payload):
+
+        body = request.get_json()
+
+        if not body or 'ids' not in body:
+            abort(400, {'message': 'request does not contain a list of "ids".'})
+
+        return multi_get(Actor, 'actors', parse_ids(body['ids']))
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /actors/<actor_id> GET 											   #
+    # ---------------------------------------------------------------------------- #
+
+    @app.route('/actors/<actor_id>', methods=['GET'])
+    @requires_auth('read:actors')
+    @rate_limit('default')
+    def get_actor(payload, actor_id):
+
+        actor = Actor.get_formatted(parse_id(actor_id))
+
+        if not actor:
+            abort(404, {'message': 'Actor with id {} not found in database.'.format(actor_id)})
+
         return jsonify({
             'success': True,
-            'actors': actors_paginated
+            'actor': actor
         })
 
     # ---------------------------------------------------------------------------- #
@@ -89,6 +365,8 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('create:actors')
+    @rate_limit('default')
+    @idempotent
     def insert_actors(payload):
 
         body = request.get_json()
@@ -109,7 +387,7 @@ def create_app(test_config=None):
 
         new_actor = Actor(
             name=name,
-            age=age,
+            age=parse_age(age),
             gender=gender
         )
 
@@ -126,6 +404,7 @@ def create_app(test_config=None):
 
     @app.route('/actors/<actor_id>', methods=['PATCH'])
     @requires_auth('edit:actors')
+    @rate_limit('default')
     def edit_actors(payload, actor_id):
 
         body = request.get_json()
@@ -136,25 +415,20 @@ def create_app(test_config=None):
         if not body:
             abort(400, {'message': 'request does not contain a valid JSON body.'})
 
-        actor_to_update = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-        if not actor_to_update:
-            abort(404, {'message': 'Actor with id {} not found in database.'.format(actor_id)})
+        values = {field: body[field] for field in ('name', 'age', 'gender') if field in body}
 
-        name = body.get('name', actor_to_update.name)
-        age = body.get('age', actor_to_update.age)
-        gender = body.get('gender', actor_to_update.gender)
+        if 'age' in values:
+            values['age'] = parse_age(values['age'])
 
-        actor_to_update.name = name
-        actor_to_update.age = age
-        actor_to_update.gender = gender
+        actor = Actor.update_by_id(parse_id(actor_id), values)
 
-        actor_to_update.update()
+        if not actor:
+            abort(404, {'message': 'Actor with id {} not found in database.'.format(actor_id)})
 
         return jsonify({
             'success': True,
-            'updated': actor_to_update.id,
-            'actor': [actor_to_update.format()]
+            'updated': actor['id'],
+            'actor': [actor]
         })
 
     # ---------------------------------------------------------------------------- #
@@ -163,18 +437,15 @@ def create_app(test_config=None):
 
     @app.route('/actors/<actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
+    @rate_limit('default')
     def delete_actors(payload, actor_id):
 
         if not actor_id:
             abort(400, {'message': 'please append an actor id to the request url.'})
 
-        actor_to_delete = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-        if not actor_to_delete:
+        if not Actor.delete_by_id(parse_id(actor_id)):
             abort(404, {'message': 'Actor with id {} not found in database.'.format(actor_id)})
 
-        actor_to_delete.delete()
-
         return jsonify({
             'success': True,
             'deleted': actor_id
@@ -186,17 +457,85 @@ def create_app(test_config=None):
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('read:movies')
+    @rate_limit('list')
+    @coalesce
     def get_movies(payload):
 
-        selection = Movie.query.all()
+        if 'ids' in request.args:
+            return multi_get(Movie, 'movies', parse_ids(request.args['ids']))
+
+        selection = sorted_query(Movie, MOVIE_SORT_FIELDS).all()
         movies_paginated = paginate_results(request, selection)
 
         if len(movies_paginated) == 0:
             abort(404, {'message': 'no movies found in database.'})
 
+        return render_list('movies', movies_paginated)
+
+    @app.route('/movies/lookup', methods=['POST'])
+    @requires_auth('read:movies')
+    @rate_limit('list')
+    def lookup_movies(payload):
+
+        body = request.get_json()
+
+        if not body or 'ids' not in body:
+            abort(400, {'message': 'request does not contain a list of "ids".'})
+
+        return multi_get(Movie, 'movies', parse_ids(body['ids']))
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoints /movies/releases and /movies/calendar GET 						   #
+    # ---------------------------------------------------------------------------- #
+
+    @app.route('/movies/releases', methods=['GET'])
+    @requires_auth('read:movies')
+    @rate_limit('list')
+    @coalesce
+    def get_releases(payload):
+
+        start = parse_date('from', date.today())
+        end = parse_date('to')
+        limit = parse_limit(RELEASES_PAGE_SIZE, RELEASES_MAX_PAGE_SIZE)
+
+        return render_list('movies', [movie.format() for movie in movies_released(start, end, limit)])
+
+    @app.route('/movies/calendar', methods=['GET'])
+    @requires_auth('read:movies')
+    @rate_limit('list')
+    @coalesce
+    def get_release_calendar(payload):
+
+        granularity = request.args.get('granularity', 'month')
+
+        if granularity not in CALENDAR_GRANULARITIES:
+            abort(400, {'message': 'granularity must be one of {}.'.format(', '.join(CALENDAR_GRANULARITIES))})
+
+        buckets = release_calendar(granularity, parse_date('from'), parse_date('to'))
+
+        return jsonify({
+            'success': True,
+            'granularity': granularity,
+            'buckets': [{'start': start.isoformat(), 'count': count} for start, count in buckets]
+        })
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /movies/<movie_id> GET 											   #
+    # ---------------------------------------------------------------------------- #
+
+    @app.route('/movies/<movie_id>', methods=['GET'])
+    @requires_auth('read:movies')
+    @rate_limit('default')
+    def get_movie(payload, movie_id):
+
+        movie = Movie.get_formatted(parse_id(movie_id))
+
+        if not movie:
+            abort(404, {'message': 'Movie with id {} not found in database.'.format(movie_id)})
+
         return jsonify({
             'success': True,
-            'movies': movies_paginated
+            'movie': movie
         })
 
     # ---------------------------------------------------------------------------- #
@@ -205,6 +544,8 @@ def create_app(test_config=None):
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('create:movies')
+    @rate_limit('default')
+    @idempotent
     def insert_movies(payload):
 
         body = request.get_json()
@@ -223,7 +564,7 @@ def create_app(test_config=None):
 
         new_movie = Movie(
             title=title,
-            release_date=release_date
+            release_date=parse_release_date(release_date)
         )
 
         new_movie.insert()
@@ -239,6 +580,7 @@ def create_app(test_config=None):
 
     @app.route('/movies/<movie_id>', methods=['PATCH'])
     @requires_auth('edit:movies')
+    @rate_limit('default')
     def edit_movies(payload, movie_id):
 
         body = request.get_json()
@@ -249,23 +591,20 @@ def create_app(test_config=None):
         if not body:
             abort(400, {'message': 'request does not contain a valid JSON body.'})
 
-        movie_to_update = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-        if not movie_to_update:
-            abort(404, {'message': 'Movie with id {} not found in database.'.format(movie_id)})
+        values = {field: body[field] for field in ('title', 'release_date') if field in body}
 
-        title = body.get('title', movie_to_update.title)
-        release_date = body.get('release_date', movie_to_update.release_date)
+        if 'release_date' in values:
+            values['release_date'] = parse_release_date(values['release_date'])
 
-        movie_to_update.title = title
-        movie_to_update.release_date = release_date
+        movie = Movie.update_by_id(parse_id(movie_id), values)
 
-        movie_to_update.update()
+        if not movie:
+            abort(404, {'message': 'Movie with id {} not found in database.'.format(movie_id)})
 
         return jsonify({
             'success': True,
-            'edited': movie_to_update.id,
-            'movie': [movie_to_update.format()]
+            'edited': movie['id'],
+            'movie': [movie]
         })
 
     # ---------------------------------------------------------------------------- #
@@ -274,21 +613,404 @@ def create_app(test_config=None):
 
     @app.route('/movies/<movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
+    @rate_limit('default')
     def delete_movies(payload, movie_id):
 
         if not movie_id:
             abort(400, {'message': 'please append an movie id to the request url.'})
 
-        movie_to_delete = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        if not Movie.delete_by_id(parse_id(movie_id)):
+            abort(404, {'message': 'Movie with id {} not found in database.'.format(movie_id)})
+
+        return jsonify({
+            'success': True,
+            'deleted': movie_id
+        })
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoints /movies/<movie_id>/actors (casting)		 						   #
+    # ---------------------------------------------------------------------------- #
+
+    def get_movie_or_404(movie_id):
+        movie = Movie.live().filter(Movie.id == movie_id).one_or_none()
 
-        if not movie_to_delete:
+        if not movie:
             abort(404, {'message': 'Movie with id {} not found in database.'.format(movie_id)})
 
-        movie_to_delete.delete()
+        return movie
+
+    def parse_cast(body):
+        # Accepts {"actors": [{"id": 1, "actor_fee": 750.0}, 2, ...]} and
+        # returns {actor_id: actor_fee}.
+        if not body or not isinstance(body.get('actors'), list) or not body['actors']:
+            abort(400, {'message': 'request does not contain a list of "actors".'})
+
+        fees = {}
+        for entry in body['actors']:
+            try:
+                if isinstance(entry, dict):
+                    fee = entry.get('actor_fee')
+                    fees[int(entry['id'])] = None if fee is None else float(fee)
+                else:
+                    fees[int(entry)] = None
+            except (KeyError, TypeError, ValueError):
+                abort(422, {'message': 'invalid actor entry {}.'.format(entry)})
+
+        return fees
+
+    @app.route('/movies/<movie_id>/actors', methods=['GET'])
+    @requires_auth('read:movies')
+    @rate_limit('default')
+    def get_movie_cast(payload, movie_id):
+
+        movie = get_movie_or_404(movie_id)
 
         return jsonify({
             'success': True,
-            'deleted': movie_id
+            'movie': movie.id,
+            'actors': movie_cast(movie.id)
+        })
+
+    @app.route('/movies/<movie_id>/actors', methods=['POST'])
+    @requires_auth('edit:movies')
+    @rate_limit('bulk')
+    def cast_movie_actors(payload, movie_id):
+
+        fees = parse_cast(request.get_json())
+        movie = get_movie_or_404(movie_id)
+
+        missing = set(fees) - existing_actor_ids(list(fees))
+        if missing:
+            abort(404, {'message': 'Actors with ids {} not found in database.'.format(sorted(missing))})
+
+        cast, already_cast = cast_actors(movie.id, fees)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.id,
+            'cast': cast,
+            'already_cast': already_cast
+        })
+
+    @app.route('/movies/<movie_id>/actors', methods=['PATCH'])
+    @requires_auth('edit:movies')
+    @rate_limit('bulk')
+    def edit_movie_actor_fees(payload, movie_id):
+
+        fees = parse_cast(request.get_json())
+        movie = get_movie_or_404(movie_id)
+
+        updated, not_cast = update_actor_fees(movie.id, fees)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.id,
+            'updated': updated,
+            'not_cast': not_cast
+        })
+
+    @app.route('/movies/<movie_id>/actors', methods=['DELETE'])
+    @app.route('/movies/<movie_id>/actors/<actor_id>', methods=['DELETE'])
+    @requires_auth('edit:movies')
+    @rate_limit('bulk')
+    def uncast_movie_actors(payload, movie_id, actor_id=None):
+
+        actor_ids = parse_ids(actor_id or request.args.get('ids', ''))
+
+        if not actor_ids:
+            abort(400, {'message': 'please append an actor id or ?ids= to the request url.'})
+
+        movie = get_movie_or_404(movie_id)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.id,
+            'removed': uncast_actors(movie.id, actor_ids)
+        })
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /changes GET		 												   #
+    # ---------------------------------------------------------------------------- #
+
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('read:actors')
+    @rate_limit('list')
+    def get_changes(payload):
+
+        check_permissions('read:movies', payload)
+
+        since = request.args.get('since', 0, type=int)
+        limit = parse_limit(CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE)
+
+        changes = [change.format() for change in changes_since(since, limit)]
+
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'next': changes[-1]['seq'] if changes else since
+        })
+
+    @app.route('/changes/stream', methods=['GET'])
+    @requires_auth('read:actors')
+    @rate_limit('list')
+    def stream_changes(payload):
+
+        check_permissions('read:movies', payload)
+
+        since = request.headers.get('Last-Event-ID', type=int)
+        if since is None:
+            since = request.args.get('since', 0, type=int)
+
+        def events(since):
+            deadline = time.monotonic() + CHANGE_STREAM_MAX_SECONDS
+
+            while time.monotonic() < deadline:
+                changes = [change.format() for change in changes_since(since, CHANGES_MAX_PAGE_SIZE)]
+                # End the read transaction so the connection goes back to
+                # the pool while we sleep.
+                db.session.rollback()
+
+                for change in changes:
+                    since = change['seq']
+                    yield 'id: {}\nevent: change\ndata: {}\n\n'.format(
+                        since, json.dumps(change, cls=app.json_encoder))
+
+                if not changes:
+                    yield ': keep-alive\n\n'
+                    time.sleep(CHANGE_STREAM_POLL_SECONDS)
+
+        return Response(
+            stream_with_context(events(since)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'}
+        )
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /export/<table> POST	 											   #
+    # ---------------------------------------------------------------------------- #
+
+    @app.route('/export/<table>', methods=['POST'])
+    @requires_auth('read:movies')
+    @rate_limit('export')
+    @idempotent
+    def export_table(payload, table):
+
+        check_permissions('read:actors', payload)
+
+        if table not in EXPORT_TABLES:
+            abort(404, {'message': 'no export for {}.'.format(table)})
+
+        # Runs as an export job, so no web worker is held for the length of
+        # a table scan; the file is fetched from the job once it succeeds.
+        job = enqueue('export', parse_export({'format': 'csv', 'tables': [table]}), payload.get('sub'))
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        }), 202, {'Location': '/jobs/{}'.format(job.id)}
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /jobs POST		 												   #
+    # ---------------------------------------------------------------------------- #
+
+    def job_request_body():
+        '''The job as JSON, or as the kind and params (JSON) fields of a multipart form with files.'''
+        if request.mimetype != 'multipart/form-data':
+            return request.get_json()
+
+        try:
+            return {'kind': request.form.get('kind'), 'params': json.loads(request.form.get('params') or '{}')}
+        except ValueError:
+            abort(400, {'message': 'params is not valid JSON.'})
+
+    @app.route('/jobs', methods=['POST'])
+    @requires_auth('read:movies')
+    @rate_limit('bulk')
+    @idempotent
+    def create_job(payload):
+
+        body = job_request_body()
+
+        if not body:
+            abort(400, {'message': 'request does not contain a valid JSON body.'})
+
+        kind = JOB_KINDS.get(body.get('kind'))
+
+        if kind is None:
+            abort(422, {'message': 'kind must be one of {}.'.format(', '.join(JOB_KINDS))})
+
+        for permission in kind.permissions:
+            check_permissions(permission, payload)
+
+        params = body.get('params') or {}
+
+        if not isinstance(params, dict):
+            abort(422, {'message': 'params must be an object.'})
+
+        unknown = set(request.files) - set(kind.inputs)
+
+        if unknown:
+            abort(422, {'message': '{} job takes no file {}.'.format(body['kind'], ', '.join(sorted(unknown)))})
+
+        inputs = {}
+
+        try:
+            # Input files are named after their uploads only, never by params.
+            for name in kind.inputs:
+                params[name] = None
+
+                if name in request.files:
+                    params[name] = import_file_name(name, request.files[name].filename)
+                    inputs[params[name]] = request.files[name].stream
+
+            params = kind.parse(params)
+        except ValueError as e:
+            abort(422, {'message': str(e)})
+
+        job = enqueue(body['kind'], params, payload.get('sub'), inputs)
+
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        }), 202, {'Location': '/jobs/{}'.format(job.id)}
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /jobs/<id> GET	 												   #
+    # ---------------------------------------------------------------------------- #
+
+    def get_job_or_404(job_id):
+        job = Job.query.get(parse_id(job_id))
+
+        if job is None:
+            abort(404, {'message': 'job {} not found.'.format(job_id)})
+
+        return job
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    @requires_auth('read:movies')
+    @rate_limit('default')
+    def get_job(payload, job_id):
+
+        return jsonify({
+            'success': True,
+            'job': get_job_or_404(job_id).format()
+        })
+
+    @app.route('/jobs/<job_id>/files/<filename>', methods=['GET'])
+    @requires_auth('read:movies')
+    @rate_limit('export')
+    def get_job_file(payload, job_id, filename):
+
+        check_permissions('read:actors', payload)
+        job = get_job_or_404(job_id)
+        files = (job.format()['result'] or {}).get('files', []) if job.status == 'succeeded' else []
+
+        if filename not in [file['file'] for file in files]:
+            abort(404, {'message': 'job {} has no file {}.'.format(job_id, filename)})
+
+        parts = file_parts(job.id, 'output', filename)
+
+        if not parts:
+            abort(404, {'message': 'job {} has no file {}.'.format(job_id, filename)})
+
+        # Stored files are already compressed (gzip, snappy), so they are
+        # passed through as they are.
+        return Response(
+            stream_with_context(read_file(parts)),
+            mimetype='application/octet-stream',
+            headers={'Content-Disposition': 'attachment; filename={}'.format(filename)},
+            direct_passthrough=True
+        )
+
+    # ---------------------------------------------------------------------------- #
+    # Endpoint /batch POST		 												   #
+    # ---------------------------------------------------------------------------- #
+
+    def invalid_subrequest(subrequest):
+        '''Why a batch item with a valid path cannot be run, or None.'''
+        if not isinstance(subrequest.get('method', 'GET'), str):
+            return '"method" must be a string.'
+
+        headers = subrequest.get('headers') or {}
+
+        if not isinstance(headers, dict) or not all(isinstance(value, str) for value in headers.values()):
+            return '"headers" must be an object of strings.'
+
+        return None
+
+    def run_subrequest(payload, subrequest):
+        problem = invalid_subrequest(subrequest)
+
+        if problem is not None:
+            return {'status': 422, 'body': {'success': False, 'error': 422, 'message': problem}}
+
+        headers = {
+            name: value for name, value in (subrequest.get('headers') or {}).items()
+            if name in BATCH_FORWARDED_HEADERS
+        }
+        # Sub-responses are embedded in the JSON batch response, so binary
+        # formats cannot be negotiated.
+        if 'msgpack' in headers.get('Accept', ''):
+            del headers['Accept']
+
+        # Nested request contexts reuse the batch's app context, so every
+        # sub-request runs on the same SQLAlchemy session.
+        with app.test_request_context(
+                subrequest['path'],
+                method=subrequest.get('method', 'GET').upper(),
+                json=subrequest.get('body'),
+                headers=headers):
+            sub_request = _request_ctx_stack.top.request
+
+            try:
+                if sub_request.routing_exception is not None:
+                    raise sub_request.routing_exception
+
+                if sub_request.url_rule.endpoint in BATCH_EXCLUDED_ENDPOINTS:
+                    abort(400, {'message': '{} cannot be batched.'.format(subrequest['path'])})
+
+                view = app.view_functions[sub_request.url_rule.endpoint]
+                permission = getattr(view, 'permission', None)
+
+                if permission is None:
+                    rv = view(**sub_request.view_args)
+                else:
+                    check_permissions(permission, payload)
+                    rv = view.__wrapped__(payload, **sub_request.view_args)
+            except Exception as e:
+                db.session.rollback()
+                rv = app.handle_user_exception(e)
+
+            # Each sub-request is its own unit of work, so a failing one does
+            # not roll back those before it.
+            response = end_unit_of_work(app.make_response(rv))
+
+        return {
+            'status': response.status_code,
+            'body': response.get_json() if response.is_json else response.get_data(as_text=True)
+        }
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+
+        payload = get_auth_payload()
+        check_rate_limit('bulk', payload)
+        body = request.get_json()
+
+        if not body or not isinstance(body.get('requests'), list):
+            abort(400, {'message': 'request does not contain a list of "requests".'})
+
+        subrequests = body['requests']
+
+        if len(subrequests) > BATCH_MAX_REQUESTS:
+            abort(422, {'message': 'at most {} requests per batch.'.format(BATCH_MAX_REQUESTS)})
+
+        if not all(isinstance(sub, dict) and isinstance(sub.get('path'), str) for sub in subrequests):
+            abort(422, {'message': 'every request needs a "path".'})
+
+        return jsonify({
+            'success': True,
+            'responses': [run_subrequest(payload, sub) for sub in subrequests]
         })
 
     # ---------------------------------------------------------------------------- #
@@ -321,6 +1043,19 @@ def create_app(test_config=None):
             "message": msg
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        try:
+            msg = error['description']
+        except TypeError:
+            msg = "conflict"
+
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": msg
+        }), 409
+
     @app.errorhandler(422)
     def unprocessable(error):
         try:
@@ -334,6 +1069,27 @@ def create_app(test_config=None):
             "message": msg
         }), 422
 
+    def with_retry_after(response, error):
+        description = getattr(error, 'description', None)
+
+        if isinstance(description, dict) and 'retry_after' in description:
+            response.headers['Retry-After'] = str(description['retry_after'])
+
+        return response
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        try:
+            msg = error['description']
+        except TypeError:
+            msg = "too many requests"
+
+        return with_retry_after(jsonify({
+            "success": False,
+            "error": 429,
+            "message": msg
+        }), error), 429
+
     @app.errorhandler(500)
     def internal_server_error(error):
         try:
@@ -347,6 +1103,35 @@ def create_app(test_config=None):
             "message": msg
         }), 500
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        try:
+            msg = error['description']
+        except TypeError:
+            msg = "service unavailable"
+
+        return with_retry_after(jsonify({
+            "success": False,
+            "error": 503,
+            "message": msg
+        }), error), 503
+
+    @app.errorhandler(OperationalError)
+    def database_error(error):
+        # Roll back first: it ends the cancelled transaction and returns the
+        # connection to the pool before the response is sent.
+        db.session.rollback()
+
+        if not is_statement_timeout(error):
+            app.logger.exception(error)
+            return internal_server_error(error)
+
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "database query timed out"
+        }), 503
+
     @app.errorhandler(AuthError)
     def authentification_failed(auth_error):
         try:
@@ -363,7 +1148,16 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+def __getattr__(name):
+    # `app` is built on first access instead of at import time, so importing
+    # this module (tests, manage.py, `gunicorn 'app:create_app()'`) stays
+    # cheap and never touches the database.
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -1,10 +1,28 @@
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
 from flask import request
 from flask import _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
-from config import auth0_config
+from sharedcache import (
+    SharedCache,
+    load_store
+)
+from config import (
+    auth0_config,
+    AUTH_ISSUERS,
+    JWKS,
+    JWKS_FILE,
+    JWKS_RELOAD_SECONDS,
+    AUTH_CACHE_BACKEND,
+    AUTH_CACHE_LOCK_SECONDS,
+    JWKS_CACHE_TTL,
+    JWKS_REFRESH_MIN_SECONDS,
+    TOKEN_CACHE_TTL
+)
 
 # ---------------------------------------------------------------------------- #
 # Auth0 Config                                                                 #
@@ -14,6 +32,12 @@ AUTH0_DOMAIN = auth0_config['AUTH0_DOMAIN']
 ALGORITHMS = auth0_config['ALGORITHMS']
 API_AUDIENCE = auth0_config['API_AUDIENCE']
 
+logger = logging.getLogger(__name__)
+
+# Fetched key sets and verified token payloads, shared by the workers on a
+# host when AUTH_CACHE_BACKEND is not `memory`; see sharedcache.py.
+auth_cache = SharedCache(load_store(AUTH_CACHE_BACKEND), lock_seconds=AUTH_CACHE_LOCK_SECONDS)
+
 # ---------------------------------------------------------------------------- #
 # AuthError Exception                                                          #
 # ---------------------------------------------------------------------------- #
@@ -102,6 +126,157 @@ def check_permissions(permission, payload):
     return True
 
 
+# ---------------------------------------------------------------------------- #
+# Signing Keys                                                                 #
+# ---------------------------------------------------------------------------- #
+
+'''
+Token issuers and their signing keys
+    verify_decode_jwt picks the issuer from the token's `iss` claim and
+    checks the signature against that issuer's key set and the audience
+    against its accepted audiences. Issuers come from AUTH_ISSUERS, or
+    default to the Auth0 tenant in auth0_config.
+
+    Key sets:
+    jwks_file   a JWKS document on disk, read at startup and re-read when its
+                mtime changes (checked at most every JWKS_RELOAD_SECONDS);
+                a file that fails to parse keeps the previous keys.
+    jwks        a JWKS document given inline (AUTH_ISSUERS or the JWKS env).
+    jwks_url    fetched from the identity provider and kept in auth_cache for
+                JWKS_CACHE_TTL seconds. A token signed with an unknown kid
+                triggers a refetch (key rotation), at most once every
+                JWKS_REFRESH_MIN_SECONDS. Fetches are single-flight across
+                workers sharing the cache.
+
+    With file or inline keys verification never performs network I/O, so
+    requests keep being authenticated while the identity provider is down.
+    `python manage.py fetch_jwks` writes the tenant's current keys to a file.
+'''
+
+
+def jwks_url(domain):
+    return 'https://{}/.well-known/jwks.json'.format(domain)
+
+
+def keys_by_kid(jwks):
+    return {key['kid']: key for key in jwks['keys'] if 'kid' in key}
+
+
+class StaticKeySet(object):
+    def __init__(self, jwks):
+        self._keys = keys_by_kid(json.loads(jwks) if isinstance(jwks, str) else jwks)
+
+    def get(self, kid):
+        return self._keys.get(kid)
+
+
+class FileKeySet(object):
+    def __init__(self, path, reload_seconds=JWKS_RELOAD_SECONDS, clock=time.monotonic):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime
+        self._keys = self._read()
+        self._next_check = clock() + reload_seconds
+
+    def _read(self):
+        with open(self.path) as source:
+            return keys_by_kid(json.load(source))
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            logger.exception('keeping previous signing keys, cannot stat %s', self.path)
+            return
+
+        if mtime == self._mtime:
+            return
+
+        # Recorded before reading, so a broken file is retried only once it
+        # changes again rather than on every check.
+        self._mtime = mtime
+        try:
+            self._keys = self._read()
+            logger.info('reloaded signing keys from %s', self.path)
+        except (OSError, ValueError, KeyError):
+            logger.exception('keeping previous signing keys, cannot read %s', self.path)
+
+    def get(self, kid):
+        now = self.clock()
+
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._reload_if_changed()
+                    self._next_check = now + self.reload_seconds
+
+        return self._keys.get(kid)
+
+
+class RemoteKeySet(object):
+    def __init__(self, url):
+        self.url = url
+        self.cache_key = 'jwks:' + url
+
+    def _fetch(self):
+        # Imported lazily, see verify_decode_jwt.
+        from urllib.request import urlopen
+
+        return {'jwks': json.loads(urlopen(self.url).read()), 'fetched_at': time.time()}
+
+    def get(self, kid):
+        document = auth_cache.get_or_refresh(self.cache_key, self._fetch, JWKS_CACHE_TTL)
+        key = keys_by_kid(document['jwks']).get(kid)
+
+        if key is None and time.time() - document['fetched_at'] >= JWKS_REFRESH_MIN_SECONDS:
+            document = auth_cache.refresh(self.cache_key, self._fetch, JWKS_CACHE_TTL, stale=document)
+            key = keys_by_kid(document['jwks']).get(kid)
+
+        return key
+
+
+class Issuer(object):
+    def __init__(self, issuer, audience, keys, algorithms=None):
+        self.issuer = issuer
+        self.audiences = {audience} if isinstance(audience, str) else set(audience or ())
+        self.keys = keys
+        self.algorithms = algorithms or ALGORITHMS
+
+    def accepts_audience(self, aud):
+        aud = [aud] if isinstance(aud, str) else aud or []
+        return bool(self.audiences.intersection(aud))
+
+
+def load_issuer(config):
+    if config.get('jwks_file'):
+        keys = FileKeySet(config['jwks_file'])
+    elif config.get('jwks'):
+        keys = StaticKeySet(config['jwks'])
+    else:
+        keys = RemoteKeySet(config.get('jwks_url') or jwks_url(config['issuer'].split('/')[2]))
+
+    return Issuer(config['issuer'], config['audience'], keys, config.get('algorithms'))
+
+
+def default_issuers():
+    return [{
+        'issuer': 'https://{}/'.format(AUTH0_DOMAIN),
+        'audience': API_AUDIENCE,
+        'jwks_file': JWKS_FILE,
+        'jwks': JWKS,
+        'jwks_url': jwks_url(AUTH0_DOMAIN)
+    }]
+
+
+def load_issuers(configs):
+    return {config['issuer']: load_issuer(config) for config in configs}
+
+
+issuers = load_issuers(AUTH_ISSUERS or default_issuers())
+
+
 '''
 @TODO(Done): Implement verify_decode_jwt(token) method
     @INPUTS
@@ -119,9 +294,24 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
+    # jose is imported lazily: it pulls in the crypto backends, none of which
+    # are needed to import the app or to serve unauthenticated routes.
+    from jose import jwt
+
+    token_key = 'token:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+    payload = auth_cache.get(token_key) if TOKEN_CACHE_TTL else None
+
+    if payload is not None:
+        return payload
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+        unverified_claims = jwt.get_unverified_claims(token)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -129,27 +319,25 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    issuer = issuers.get(unverified_claims.get('iss'))
+
+    if issuer is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Unknown token issuer.'
+        }, 401)
+
+    rsa_key = issuer.keys.get(unverified_header['kid'])
+
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=issuer.algorithms,
+                issuer=issuer.issuer,
+                options={'verify_aud': False}
             )
-            return payload
-
         except jwt.ExpiredSignatureError:
             raise AuthError({
                 'code': 'token_expired',
@@ -168,6 +356,20 @@ def verify_decode_jwt(token):
                 'description': 'Unable to parse authentication token.'
             }, 400)
 
+        if not issuer.accepts_audience(payload.get('aud')):
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Incorrect claims. Please, check the audience and issuer.'
+            }, 401)
+
+        # Cached by the token's digest, never beyond its expiry.
+        ttl = TOKEN_CACHE_TTL
+        if 'exp' in payload:
+            ttl = min(ttl, payload['exp'] - time.time())
+        auth_cache.set(token_key, payload, ttl)
+
+        return payload
+
     raise AuthError({
         'code': 'invalid_header',
         'description': 'Unable to find the appropriate key.'
@@ -186,21 +388,28 @@ def verify_decode_jwt(token):
 '''
 
 
+def get_auth_payload():
+    token = get_token_auth_header()
+    try:
+        return verify_decode_jwt(token)
+    except:
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permissions not found'
+        }, 401)
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except:
-                raise AuthError({
-                    'code': 'unauthorized',
-                    'description': 'Permissions not found'
-                }, 401)
+            payload = get_auth_payload()
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
+        # Lets POST /batch check the permission and call the undecorated view
+        # (wrapper.__wrapped__) with a token it has already verified.
+        wrapper.permission = permission
         return wrapper
 
     return requires_auth_decorator
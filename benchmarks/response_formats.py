@@ -0,0 +1,79 @@
+'''
+Response format benchmark.
+
+Compares bytes on the wire and encode time of a list page rendered as
+today's `jsonify` output, as columnar JSON and (when installed) as
+MessagePack, for synthetic actors and movies.
+
+    $ python benchmarks/response_formats.py --rows 10 100 1000 --repeat 200
+'''
+import argparse
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from flask import Flask  # noqa: E402
+from serializers import (  # noqa: E402
+    render_list,
+    JSON_MIMETYPE,
+    COLUMNAR_MIMETYPE,
+    MSGPACK_MIMETYPE,
+    available_mimetypes
+)
+
+
+def actors(rows):
+    return [{
+        'id': i,
+        'name': 'Actor {}'.format(i),
+        'gender': ('Male', 'Female', 'Other')[i % 3],
+        'age': 20 + i % 50
+    } for i in range(1, rows + 1)]
+
+
+def movies(rows):
+    start = date(2000, 1, 1)
+    return [{
+        'id': i,
+        'title': 'Movie {}'.format(i),
+        'release_date': start + timedelta(days=i)
+    } for i in range(1, rows + 1)]
+
+
+def measure(app, key, records, mimetype, repeat):
+    with app.test_request_context(headers={'Accept': mimetype}):
+        size = len(render_list(key, records).get_data())
+        seconds = timeit.timeit(lambda: render_list(key, records).get_data(), number=repeat)
+
+    return size, seconds / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    mimetypes = [m for m in (JSON_MIMETYPE, COLUMNAR_MIMETYPE, MSGPACK_MIMETYPE) if m in available_mimetypes()]
+
+    print('{:<8} {:>6}  {:<32} {:>10} {:>8} {:>12}'.format(
+        'table', 'rows', 'format', 'bytes', 'vs json', 'encode us'))
+
+    for key, factory in (('actors', actors), ('movies', movies)):
+        for rows in args.rows:
+            records = factory(rows)
+            baseline = None
+
+            for mimetype in mimetypes:
+                size, micros = measure(app, key, records, mimetype, args.repeat)
+                baseline = baseline or size
+                print('{:<8} {:>6}  {:<32} {:>10} {:>7.0%} {:>12.1f}'.format(
+                    key, rows, mimetype, size, size / baseline, micros))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+Startup-time benchmark.
+
+Measures the cumulative import time of `app` (via `python -X importtime`)
+and the wall-clock time from interpreter start to the first served request.
+Both run in fresh interpreters so nothing is cached between samples.
+
+    $ python benchmarks/startup.py --runs 5 --max-import-ms 400 --max-first-request-ms 800
+
+Exits non-zero when a median exceeds its budget, so it can gate CI.
+'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+FIRST_REQUEST_SNIPPET = '''
+import time
+start = time.perf_counter()
+from app import create_app
+client = create_app().test_client()
+response = client.get('/')
+assert response.status_code == 200, response.status_code
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+def measure_import_ms():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True
+    )
+    # importtime lines look like: "import time:   self [us] | cumulative | name"
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == 'app':
+            return int(parts[1]) / 1000.0
+    raise RuntimeError('no importtime entry for module "app"')
+
+
+def measure_first_request_ms():
+    result = subprocess.run(
+        [sys.executable, '-c', FIRST_REQUEST_SNIPPET],
+        cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--max-first-request-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    imports = [measure_import_ms() for _ in range(args.runs)]
+    first_requests = [measure_first_request_ms() for _ in range(args.runs)]
+
+    import_median = statistics.median(imports)
+    first_request_median = statistics.median(first_requests)
+
+    print('import app          median {:8.1f} ms  (min {:.1f}, max {:.1f})'.format(
+        import_median, min(imports), max(imports)))
+    print('time to 1st request median {:8.1f} ms  (min {:.1f}, max {:.1f})'.format(
+        first_request_median, min(first_requests), max(first_requests)))
+
+    failed = False
+    if args.max_import_ms is not None and import_median > args.max_import_ms:
+        print('FAIL: import time over budget of {} ms'.format(args.max_import_ms))
+        failed = True
+    if args.max_first_request_ms is not None and first_request_median > args.max_first_request_ms:
+        print('FAIL: time to first request over budget of {} ms'.format(args.max_first_request_ms))
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
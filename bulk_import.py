@@ -0,0 +1,269 @@
+import csv
+import gzip
+import io
+import json
+import time
+from datetime import date
+from sqlalchemy import select
+from models import (
+    db,
+    Actor,
+    Movie,
+    Performance,
+    change_row,
+    record_changes,
+    reconcile_counters
+)
+from config import IMPORT_BATCH_SIZE
+
+# ---------------------------------------------------------------------------- #
+# Bulk Import                                                                  #
+# ---------------------------------------------------------------------------- #
+
+'''
+Loads actors, movies and performances from CSV or NDJSON files (optionally
+gzipped, detected by extension) for seeding and migrating environments.
+
+Rows are validated in a single streaming pass and written IMPORT_BATCH_SIZE
+at a time: with Postgres `COPY ... FROM STDIN`, elsewhere with one batched
+executemany INSERT. Each file is loaded in one transaction, so a failed load
+leaves nothing behind. Invalid rows are skipped and reported. on_batch, if
+given, is called after each batch is written, inside the file's transaction.
+
+Expected fields:
+    actors        name, age, gender (optional, defaults to Other)
+    movies        title, release_date (YYYY-MM-DD)
+    performances  movie_id or movie_title, actor_id or actor_name, actor_fee (optional)
+
+Performance references are resolved against the database after actors and
+movies are loaded; names that match several rows are rejected as ambiguous,
+and so are castings that already exist or appear twice in the file.
+The change log gets one `import` entry per file rather than one per row, as
+a signal for GET /changes consumers to resync that table. Imported
+performances bypass the casting helpers, so the movie and actor counters are
+reconciled once the file is loaded.
+'''
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_records(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    name = path[:-3] if path.endswith('.gz') else path
+
+    with opener(path, 'rt', newline='') as source:
+        if name.endswith(('.ndjson', '.jsonl')):
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for record in csv.DictReader(source):
+                yield record
+
+
+def _required(record, field):
+    value = record.get(field)
+
+    if value is None or value == '':
+        raise RowError('missing {}'.format(field))
+
+    return value
+
+
+def _optional_float(value):
+    return None if value is None or value == '' else float(value)
+
+
+def validate_actor(record):
+    try:
+        return {
+            'name': str(_required(record, 'name')),
+            'age': int(_required(record, 'age')),
+            'gender': record.get('gender') or 'Other'
+        }
+    except (TypeError, ValueError) as e:
+        raise RowError(str(e))
+
+
+def validate_movie(record):
+    try:
+        release_date = _required(record, 'release_date')
+        return {
+            'title': str(_required(record, 'title')),
+            'release_date': release_date if isinstance(release_date, date)
+            else date.fromisoformat(str(release_date)[:10])
+        }
+    except (TypeError, ValueError) as e:
+        raise RowError(str(e))
+
+
+class ReferenceResolver(object):
+    '''Maps ids or names/titles of actors and movies to existing ids.'''
+
+    def __init__(self):
+        self.actor_ids, self.actor_names = self._index(Actor.__table__, Actor.__table__.c.name)
+        self.movie_ids, self.movie_titles = self._index(Movie.__table__, Movie.__table__.c.title)
+        self.cast = set(db.session.execute(select([Performance.c.Movie_id, Performance.c.Actor_id])).fetchall())
+
+    @staticmethod
+    def _index(table, name_column):
+        ids = set()
+        names = {}
+
+        # Deleted actors and movies cannot be referenced.
+        rows = db.session.execute(select([table.c.id, name_column]).where(table.c.deleted_at.is_(None)))
+        for entity_id, name in rows:
+            ids.add(entity_id)
+            # None marks a name shared by several rows.
+            names[name] = None if name in names else entity_id
+
+        return ids, names
+
+    @staticmethod
+    def _resolve(record, id_field, name_field, ids, names):
+        if record.get(id_field) not in (None, ''):
+            entity_id = int(record[id_field])
+
+            if entity_id not in ids:
+                raise RowError('unknown {} {}'.format(id_field, entity_id))
+
+            return entity_id
+
+        name = _required(record, name_field)
+
+        if name not in names:
+            raise RowError('unknown {} {!r}'.format(name_field, name))
+        if names[name] is None:
+            raise RowError('ambiguous {} {!r}'.format(name_field, name))
+
+        return names[name]
+
+    def performance(self, record):
+        try:
+            row = {
+                'Movie_id': self._resolve(record, 'movie_id', 'movie_title', self.movie_ids, self.movie_titles),
+                'Actor_id': self._resolve(record, 'actor_id', 'actor_name', self.actor_ids, self.actor_names),
+                'actor_fee': _optional_float(record.get('actor_fee'))
+            }
+        except (TypeError, ValueError) as e:
+            raise RowError(str(e))
+
+        # Performance is unique on (Movie_id, Actor_id).
+        pair = (row['Movie_id'], row['Actor_id'])
+        if pair in self.cast:
+            raise RowError('actor {} already cast in movie {}'.format(pair[1], pair[0]))
+        self.cast.add(pair)
+
+        return row
+
+
+def _copy(connection, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([[row[column] for column in columns] for row in rows])
+    buffer.seek(0)
+
+    statement = 'COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table.name, ', '.join('"{}"'.format(column) for column in columns))
+
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(statement, buffer)
+
+
+def write_batches(table, columns, rows, batch_size=IMPORT_BATCH_SIZE, on_batch=None):
+    '''Writes an iterable of row dicts in batches; returns the row count.'''
+    connection = db.session.connection()
+    use_copy = connection.dialect.name == 'postgresql'
+    written = 0
+    batch = []
+
+    def flush():
+        if use_copy:
+            _copy(connection, table, columns, batch)
+        else:
+            connection.execute(table.insert(), batch)
+
+        if on_batch is not None:
+            on_batch()
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) >= batch_size:
+            flush()
+            written += len(batch)
+            batch = []
+
+    if batch:
+        flush()
+        written += len(batch)
+
+    return written
+
+
+class ImportReport(object):
+    def __init__(self, name, show_errors, report):
+        self.name = name
+        self.show_errors = show_errors
+        self.report = report
+        self.rejected = 0
+
+    def validated(self, records, validate):
+        for line, record in enumerate(records, start=1):
+            try:
+                yield validate(record)
+            except RowError as e:
+                self.rejected += 1
+
+                if self.rejected <= self.show_errors:
+                    self.report('{} record {}: {}'.format(self.name, line, e))
+                if self.rejected == self.show_errors:
+                    self.report('{}: not reporting further errors'.format(self.name))
+
+
+def import_file(name, entity, path, table, columns, validate, batch_size=IMPORT_BATCH_SIZE,
+                show_errors=100, report=print, on_batch=None):
+    start = time.perf_counter()
+    errors = ImportReport(name, show_errors, report)
+
+    try:
+        written = write_batches(table, columns, errors.validated(read_records(path), validate), batch_size,
+                                on_batch)
+        record_changes([change_row(entity, None, 'import', {'rows': written, 'source': path})])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    elapsed = time.perf_counter() - start
+    report('{:<13} {:>10} rows  {:>6} rejected  {:>10.0f} rows/s  {}'.format(
+        name, written, errors.rejected, written / elapsed if elapsed else 0, path))
+
+    return written, errors.rejected
+
+
+def bulk_import(actors=None, movies=None, performances=None, batch_size=IMPORT_BATCH_SIZE,
+                show_errors=100, report=print, on_batch=None):
+    results = {}
+
+    if actors:
+        results['actors'] = import_file(
+            'actors', 'actor', actors, Actor.__table__, ('name', 'gender', 'age'),
+            validate_actor, batch_size, show_errors, report, on_batch)
+
+    if movies:
+        results['movies'] = import_file(
+            'movies', 'movie', movies, Movie.__table__, ('title', 'release_date'),
+            validate_movie, batch_size, show_errors, report, on_batch)
+
+    if performances:
+        resolver = ReferenceResolver()
+        results['performances'] = import_file(
+            'performances', 'performance', performances, Performance, ('Movie_id', 'Actor_id', 'actor_fee'),
+            resolver.performance, batch_size, show_errors, report, on_batch)
+
+        movies_fixed, actors_fixed = reconcile_counters()
+        report('{:<13} {:>10} movies  {:>6} actors repaired'.format('counters', movies_fixed, actors_fixed))
+
+    return results
@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# ---------------------------------------------------------------------------- #
+# LRU Cache                                                                    #
+# ---------------------------------------------------------------------------- #
+
+'''
+LRUCache
+    A bounded, thread-safe, in-process cache. Entries expire `ttl` seconds
+    after they were stored and the least recently used entry is evicted once
+    `maxsize` is reached. Hit, miss and eviction counters are kept for
+    GET /metrics.
+
+    Each gunicorn worker has its own copy, so writers must invalidate the
+    entries they change; the TTL bounds how stale another worker can be.
+'''
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
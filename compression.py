@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import zlib
+from cache import LRUCache
+from config import (
+    COMPRESSION_MIN_SIZE,
+    COMPRESSION_GZIP_LEVEL,
+    COMPRESSION_BROTLI_QUALITY,
+    COMPRESSION_CACHE_SIZE,
+    COMPRESSION_CACHE_TTL,
+    COMPRESSION_CACHE_MAX_BYTES
+)
+
+try:
+    import brotli
+except ImportError:  # optional: `pip install brotli` to enable
+    brotli = None
+
+# ---------------------------------------------------------------------------- #
+# Response Compression                                                         #
+# ---------------------------------------------------------------------------- #
+
+'''
+compress_response(request, response)
+    Called from the after_request hook. Negotiates br (when the brotli package
+    is installed) or gzip via Accept-Encoding and:
+
+    - leaves bodies smaller than COMPRESSION_MIN_SIZE alone;
+    - compresses buffered bodies once and keeps the result in an LRU keyed by
+      (encoding, digest of the body), so a repeated list page is served from
+      the already-compressed copy instead of paying the compression again;
+    - compresses streamed responses (the change stream) chunk by chunk with a
+      sync flush after each chunk, so clients still receive data as it is
+      produced.
+'''
+
+compressed_cache = LRUCache(maxsize=COMPRESSION_CACHE_SIZE, ttl=COMPRESSION_CACHE_TTL)
+
+
+def choose_encoding(accept_encodings):
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return accept_encodings.best_match(offered)
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+
+def compress_cached(body, encoding):
+    if len(body) > COMPRESSION_CACHE_MAX_BYTES:
+        return compress(body, encoding)
+
+    key = (encoding, hashlib.sha1(body).digest())
+    compressed = compressed_cache.get(key)
+
+    if compressed is None:
+        compressed = compress(body, encoding)
+        compressed_cache.set(key, compressed)
+
+    return compressed
+
+
+def compress_stream(chunks, encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(_to_bytes(chunk)) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    # wbits 16 + MAX_WBITS writes a gzip header and trailer.
+    compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(_to_bytes(chunk)) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def _to_bytes(chunk):
+    return chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+def compress_response(request, response):
+    if (request.method == 'HEAD'
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+
+        if len(body) < COMPRESSION_MIN_SIZE:
+            return response
+
+        response.set_data(compress_cached(body, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -1,11 +1,14 @@
+import json
 import os
 from dotenv import load_dotenv
 
-load_dotenv()
+basedir = os.path.abspath(os.path.dirname(__file__))
 
-SECRET_KEY = os.urandom(32)
+# Load the project's own .env explicitly rather than letting python-dotenv
+# walk the call stack and parent directories looking for one.
+load_dotenv(os.path.join(basedir, '.env'))
 
-basedir = os.path.abspath(os.path.dirname(__file__))
+SECRET_KEY = os.urandom(32)
 
 auth0_config = {
     "AUTH0_DOMAIN": os.environ.get('AUTH0_DOMAIN'),
@@ -22,3 +25,145 @@ bearer_tokens = {
 }
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+
+# Stored responses for `Idempotency-Key` requests are kept this long before
+# `python manage.py expire_idempotency_keys` removes them.
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+
+# GET /changes page size, and how the /changes/stream (Server-Sent Events)
+# endpoint polls for new rows and how long one stream stays open before the
+# client is expected to reconnect with Last-Event-ID. Each open stream holds
+# a web worker thread for that long.
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', 100))
+CHANGES_MAX_PAGE_SIZE = int(os.environ.get('CHANGES_MAX_PAGE_SIZE', 1000))
+CHANGE_STREAM_POLL_SECONDS = float(os.environ.get('CHANGE_STREAM_POLL_SECONDS', 2))
+CHANGE_STREAM_MAX_SECONDS = float(os.environ.get('CHANGE_STREAM_MAX_SECONDS', 300))
+
+# Maximum number of sub-requests accepted by one POST /batch call.
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', 25))
+
+# Per-worker cache of single actors/movies served by GET /actors/<id> and
+# GET /movies/<id>. A size of 0 disables it; the TTL (seconds) bounds how
+# stale a record can be in a worker that did not perform the write.
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 1024))
+ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 60))
+
+# Multi-get (GET /actors?ids=..., POST /actors/lookup): ids per
+# `WHERE id IN (...)` statement and maximum ids per request.
+MULTI_GET_CHUNK_SIZE = int(os.environ.get('MULTI_GET_CHUNK_SIZE', 500))
+MULTI_GET_MAX_IDS = int(os.environ.get('MULTI_GET_MAX_IDS', 10000))
+
+# Response compression (gzip, or brotli when installed). Bodies smaller than
+# COMPRESSION_MIN_SIZE bytes are sent as-is; compressed copies of bodies up to
+# COMPRESSION_CACHE_MAX_BYTES are kept in a per-worker LRU so identical list
+# pages are only compressed once.
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+COMPRESSION_CACHE_SIZE = int(os.environ.get('COMPRESSION_CACHE_SIZE', 256))
+COMPRESSION_CACHE_TTL = float(os.environ.get('COMPRESSION_CACHE_TTL', 300))
+COMPRESSION_CACHE_MAX_BYTES = int(os.environ.get('COMPRESSION_CACHE_MAX_BYTES', 1024 * 1024))
+
+# Rows fetched per server-side cursor batch by the catalog export.
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 10000))
+
+# Rows per COPY / executemany batch for `python manage.py import`.
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 50000))
+
+
+def rate_limit_budget(name, default):
+    # "rate,burst": tokens refilled per second and bucket size. A rate of 0
+    # disables the budget.
+    rate, burst = os.environ.get('RATE_LIMIT_' + name.upper(), default).split(',')
+    return float(rate), float(burst)
+
+
+# Per-client token buckets, see ratelimit.py. `list` covers whole-table and
+# multi-record reads, `export` the export endpoints, `bulk` batch and casting
+# writes; everything else is charged to `default`.
+RATE_LIMITS = {
+    'default': rate_limit_budget('default', '20,40'),
+    'list': rate_limit_budget('list', '5,20'),
+    'export': rate_limit_budget('export', '0.2,2'),
+    'bulk': rate_limit_budget('bulk', '2,10')
+}
+
+# memory, sqlite:<path> (shared by all workers on a host) or <module>:<Class>.
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+
+# Permission a token needs to read GET /metrics (cache, rate limit and load
+# statistics). Grant it to the monitoring client, not to API users.
+METRICS_PERMISSION = os.environ.get('METRICS_PERMISSION', 'read:metrics')
+
+# Requests handled concurrently before shedding with 503 (0 = no cap). With
+# the memory backend the cap is per worker process; sqlite:<path> makes it
+# one cap for all workers on the host. Slots held longer than
+# INFLIGHT_STALE_SECONDS (e.g. by a killed worker) are reclaimed.
+MAX_INFLIGHT_REQUESTS = int(os.environ.get('MAX_INFLIGHT_REQUESTS', 64))
+INFLIGHT_BACKEND = os.environ.get('INFLIGHT_BACKEND', 'memory')
+INFLIGHT_STALE_SECONDS = float(os.environ.get('INFLIGHT_STALE_SECONDS', 900))
+
+# Statement timeout (ms) applied to every query a request runs; 0 disables it.
+# STATEMENT_TIMEOUTS overrides it per endpoint (the view function name) as
+# JSON, e.g. '{"get_actors": 2000}'.
+STATEMENT_TIMEOUT_MS = int(os.environ.get('STATEMENT_TIMEOUT_MS', 5000))
+STATEMENT_TIMEOUTS = json.loads(os.environ.get('STATEMENT_TIMEOUTS', '{}'))
+
+# Unit of work per request: model write helpers only flush and the request
+# commits once after the view returns (rolled back on an error response).
+# Set to 0 to commit inside every helper call instead.
+UNIT_OF_WORK = os.environ.get('UNIT_OF_WORK', '1') not in ('0', 'false', 'False')
+
+# Movie release timeline (GET /movies/releases, GET /movies/calendar): default
+# and maximum number of movies per response, and how long (seconds) the
+# per-granularity release counts are cached when no movie is written.
+RELEASES_PAGE_SIZE = int(os.environ.get('RELEASES_PAGE_SIZE', 100))
+RELEASES_MAX_PAGE_SIZE = int(os.environ.get('RELEASES_MAX_PAGE_SIZE', 1000))
+RELEASE_CALENDAR_CACHE_TTL = float(os.environ.get('RELEASE_CALENDAR_CACHE_TTL', 300))
+
+# Token issuers accepted by the API, as a JSON list of objects with `issuer`,
+# `audience` (a string or a list) and one key source: `jwks_file` (a JWKS
+# document on disk, reloaded when it changes), `jwks` (inline JWKS) or
+# `jwks_url`. Without it, the Auth0 tenant above is the only issuer; its keys
+# are read from JWKS_FILE or JWKS (inline JSON) when set, so that tokens are
+# verified without calling Auth0, and fetched from the tenant otherwise.
+AUTH_ISSUERS = json.loads(os.environ.get('AUTH_ISSUERS') or 'null')
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS = os.environ.get('JWKS')
+# How often (seconds) a JWKS file is checked for changes.
+JWKS_RELOAD_SECONDS = float(os.environ.get('JWKS_RELOAD_SECONDS', 1))
+
+# Cache of fetched key sets (jwks_url issuers) and verified token payloads:
+# memory (per worker), sqlite:<path> (shared by all workers on a host) or
+# <module>:<Class>. Payloads are kept TOKEN_CACHE_TTL seconds at most (0
+# disables that), fetched key sets JWKS_CACHE_TTL seconds. A token with an
+# unknown key id refetches the keys at most every JWKS_REFRESH_MIN_SECONDS;
+# while one worker refetches, the others wait up to AUTH_CACHE_LOCK_SECONDS.
+AUTH_CACHE_BACKEND = os.environ.get('AUTH_CACHE_BACKEND', 'memory')
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 60))
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_REFRESH_MIN_SECONDS = float(os.environ.get('JWKS_REFRESH_MIN_SECONDS', 30))
+AUTH_CACHE_LOCK_SECONDS = float(os.environ.get('AUTH_CACHE_LOCK_SECONDS', 10))
+
+# Tombstoned actors/movies removed per transaction by `python manage.py purge`.
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+
+# Background jobs (POST /jobs, run by `python manage.py worker`): threads per
+# worker process, how often (seconds) an idle thread polls the queue, and how
+# often a worker marks its running jobs alive. A running job not marked alive
+# for JOB_STALE_SECONDS (its worker died) is queued again, up to
+# JOB_MAX_ATTEMPTS runs in all. Uploaded import files and export results are
+# stored in the database (the job_files table) in parts of JOB_FILE_PART_BYTES;
+# jobs finished more than JOB_RETENTION_HOURS ago are deleted with their files.
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', 2))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', 10))
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_FILE_PART_BYTES = int(os.environ.get('JOB_FILE_PART_BYTES', 1024 * 1024))
+JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', 24 * 7))
+
+# Identical GET list reads served by a worker at the same time share one
+# database execution and response body (see singleflight.py). Set to 0 to run
+# every request on its own.
+REQUEST_COALESCING = os.environ.get('REQUEST_COALESCING', '1') not in ('0', 'false', 'False')
@@ -0,0 +1,202 @@
+import csv
+import gzip
+import os
+import time
+from importlib.util import find_spec
+from sqlalchemy import (
+    and_,
+    select,
+    Integer,
+    Float,
+    Date,
+    DateTime
+)
+from models import (
+    db,
+    Actor,
+    Movie,
+    Performance
+)
+from config import EXPORT_BATCH_SIZE
+
+# ---------------------------------------------------------------------------- #
+# Catalog Export                                                               #
+# ---------------------------------------------------------------------------- #
+
+'''
+Dumps actors, movies and Performance to one file per table, for offline
+jobs. Rows are read through a server-side cursor (stream_results, a named
+cursor on psycopg2) in EXPORT_BATCH_SIZE batches and written batch by batch,
+so memory stays bounded by one batch whatever the table size. Deleted
+actors and movies (see models.py, Soft Delete) are left out.
+
+Formats:
+    parquet   one row group per batch (needs pyarrow)
+    arrow     Arrow IPC file, one record batch per batch (needs pyarrow)
+    csv       gzip-compressed CSV with a header row
+
+pyarrow is optional (`pip install pyarrow`) and only imported by the parquet
+and arrow writers: importing it costs tens of milliseconds, which every
+process importing the app would otherwise pay.
+'''
+
+EXPORT_TABLES = {
+    'actors': Actor.__table__,
+    'movies': Movie.__table__,
+    'performances': Performance
+}
+
+# Columns written per table, by table name: the catalog itself, without the
+# derived counters (see models.py, Denormalized Counters) or the always empty
+# deleted_at of exported rows.
+EXPORT_COLUMNS = {
+    'actors': ('id', 'name', 'gender', 'age'),
+    'movies': ('id', 'title', 'release_date'),
+    'Performance': ('Movie_id', 'Actor_id', 'actor_fee')
+}
+
+EXPORT_FORMATS = ('parquet', 'arrow', 'csv')
+
+FILE_EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'csv': '.csv.gz'
+}
+
+
+def has_pyarrow():
+    return find_spec('pyarrow') is not None
+
+
+def load_pyarrow():
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    return pyarrow
+
+
+def default_format():
+    return 'parquet' if has_pyarrow() else 'csv'
+
+
+def export_columns(table):
+    return [table.c[name] for name in EXPORT_COLUMNS[table.name]]
+
+
+def live_rows(table):
+    '''SELECT of a table without deleted actors/movies or their Performance rows.'''
+    if table is Performance:
+        movies, actors = Movie.__table__, Actor.__table__
+        return select(export_columns(table)).where(and_(
+            table.c.Movie_id.in_(select([movies.c.id]).where(movies.c.deleted_at.is_(None))),
+            table.c.Actor_id.in_(select([actors.c.id]).where(actors.c.deleted_at.is_(None)))
+        ))
+
+    return select(export_columns(table)).where(table.c.deleted_at.is_(None))
+
+
+def iter_batches(table, batch_size=EXPORT_BATCH_SIZE):
+    connection = db.engine.connect().execution_options(stream_results=True)
+
+    try:
+        result = connection.execute(live_rows(table))
+
+        while True:
+            rows = result.fetchmany(batch_size)
+
+            if not rows:
+                break
+
+            yield [tuple(row) for row in rows]
+    finally:
+        connection.close()
+
+
+def column_names(table):
+    return list(EXPORT_COLUMNS[table.name])
+
+
+def arrow_schema(table):
+    pyarrow = load_pyarrow()
+
+    def arrow_type(column):
+        if isinstance(column.type, Integer):
+            return pyarrow.int64()
+        if isinstance(column.type, Float):
+            return pyarrow.float64()
+        if isinstance(column.type, DateTime):
+            return pyarrow.timestamp('us')
+        if isinstance(column.type, Date):
+            return pyarrow.date32()
+        return pyarrow.string()
+
+    return pyarrow.schema([(column.name, arrow_type(column)) for column in export_columns(table)])
+
+
+def arrow_batch(schema, rows):
+    pyarrow = load_pyarrow()
+    columns = list(zip(*rows))
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema
+    )
+
+
+def export_table(name, out_dir, fmt, batch_size=EXPORT_BATCH_SIZE):
+    '''Writes one table to out_dir and returns (path, rows written).'''
+    if fmt in ('parquet', 'arrow') and not has_pyarrow():
+        raise RuntimeError('{} export needs pyarrow; use --format csv'.format(fmt))
+
+    table = EXPORT_TABLES[name]
+    path = os.path.join(out_dir, name + FILE_EXTENSIONS[fmt])
+    written = 0
+
+    if fmt == 'csv':
+        with gzip.open(path, 'wt', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(column_names(table))
+            for rows in iter_batches(table, batch_size):
+                writer.writerows(rows)
+                written += len(rows)
+        return path, written
+
+    pyarrow = load_pyarrow()
+    schema = arrow_schema(table)
+
+    if fmt == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression='snappy')
+    else:
+        writer = pyarrow.ipc.new_file(path, schema)
+
+    try:
+        for rows in iter_batches(table, batch_size):
+            batch = arrow_batch(schema, rows)
+
+            if fmt == 'parquet':
+                writer.write_table(pyarrow.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+
+            written += len(rows)
+    finally:
+        writer.close()
+
+    return path, written
+
+
+def export_catalog(out_dir, fmt=None, batch_size=EXPORT_BATCH_SIZE, tables=None, report=print):
+    fmt = fmt or default_format()
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+
+    for name in tables or EXPORT_TABLES:
+        start = time.perf_counter()
+        path, rows = export_table(name, out_dir, fmt, batch_size)
+        elapsed = time.perf_counter() - start
+
+        report('{:<13} {:>10} rows  {:>10.0f} rows/s  {}'.format(
+            name, rows, rows / elapsed if elapsed else 0, path))
+        results.append((name, path, rows))
+
+    return results
@@ -0,0 +1,113 @@
+from functools import wraps
+from flask import (
+    request,
+    abort,
+    make_response,
+    Response
+)
+from models import (
+    db,
+    commit,
+    insert_ignore,
+    IdempotencyKey
+)
+from ratelimit import client_id
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# ---------------------------------------------------------------------------- #
+# Idempotent Requests                                                          #
+# ---------------------------------------------------------------------------- #
+
+'''
+@idempotent decorator
+    Makes a create endpoint safe to retry. Clients send an `Idempotency-Key`
+    header; the first request with a given key runs the view and stores its
+    response, every retry replays the stored response without touching the
+    actor/movie tables again.
+
+    Keys belong to the client that sent them (client_id, as for rate
+    limits), so two clients choosing the same key never see each other's
+    responses.
+
+    A replay costs exactly one primary-key SELECT. The key is claimed with
+    INSERT ... ON CONFLICT DO NOTHING (INSERT OR IGNORE on SQLite) inside the
+    same transaction as the view's own insert, so two concurrent requests with
+    the same key can never both create a row.
+
+    The replay has the stored status, body and Location header.
+
+    Requests without the header behave exactly as before.
+    Must be applied below @requires_auth, as it receives the decoded payload.
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+
+        if not key:
+            return f(payload, *args, **kwargs)
+
+        subject = client_id(payload)
+
+        stored = IdempotencyKey.query.get((subject, key))
+
+        if stored is None:
+            claim = insert_ignore(IdempotencyKey.__table__).values(
+                subject=subject,
+                key=key,
+                method=request.method,
+                path=request.path
+            )
+
+            if db.session.execute(claim).rowcount:
+                return _run_and_store(subject, key, f, payload, *args, **kwargs)
+
+            stored = IdempotencyKey.query.get((subject, key))
+
+        return _replay(stored)
+
+    return wrapper
+
+
+def _run_and_store(subject, key, f, payload, *args, **kwargs):
+    # The claim is flushed but not committed: the commit that persists the
+    # view's writes persists it too, and an abort() rolls both back so the
+    # client can retry with the same key.
+    response = make_response(f(payload, *args, **kwargs))
+
+    if response.status_code >= 500:
+        db.session.rollback()
+        return response
+
+    IdempotencyKey.query.filter(IdempotencyKey.subject == subject, IdempotencyKey.key == key).update({
+        'status_code': response.status_code,
+        'response': response.get_data(as_text=True),
+        'location': response.headers.get('Location')
+    })
+    commit()
+
+    return response
+
+
+def _replay(stored):
+    if not stored.matches(request.method, request.path):
+        abort(422, {'message': '{} was already used for a different request.'.format(IDEMPOTENCY_HEADER)})
+
+    if stored.status_code is None:
+        abort(409, {'message': 'a request with this {} is still in progress.'.format(IDEMPOTENCY_HEADER)})
+
+    response = Response(
+        stored.response,
+        status=stored.status_code,
+        mimetype='application/json'
+    )
+    response.headers['Idempotent-Replayed'] = 'true'
+
+    # e.g. the job a 202 from POST /jobs points to.
+    if stored.location:
+        response.headers['Location'] = stored.location
+
+    return response
@@ -0,0 +1,533 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import (
+    and_,
+    select
+)
+from models import (
+    db,
+    commit,
+    reconcile_counters,
+    purge_deleted,
+    Job,
+    JobFile
+)
+from bulk_import import bulk_import
+import export
+from export import (
+    EXPORT_FORMATS,
+    EXPORT_TABLES,
+    export_catalog
+)
+from config import (
+    EXPORT_BATCH_SIZE,
+    IMPORT_BATCH_SIZE,
+    PURGE_BATCH_SIZE,
+    JOB_WORKER_CONCURRENCY,
+    JOB_POLL_SECONDS,
+    JOB_HEARTBEAT_SECONDS,
+    JOB_STALE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_FILE_PART_BYTES,
+    JOB_RETENTION_HOURS
+)
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+# Background Jobs                                                              #
+# ---------------------------------------------------------------------------- #
+
+'''
+Background jobs
+    Exports, imports, counter reconciliation and purges run outside the web
+    workers: POST /jobs queues a row in the `jobs` table and answers 202 with
+    its id, `python manage.py worker` runs it, and GET /jobs/<id> reports
+    its status and progress. The queue is the application database itself,
+    so nothing besides it needs to be running.
+
+    A worker process runs JOB_WORKER_CONCURRENCY jobs at a time, one per
+    thread, and any number of worker processes can share the queue. A job
+    is claimed with a compare-and-set UPDATE (status queued -> running) that
+    only one worker can win; on Postgres the candidate row is selected FOR
+    UPDATE SKIP LOCKED, so concurrent workers pick different jobs instead of
+    contending for the same one.
+
+    Workers mark their running jobs alive every JOB_HEARTBEAT_SECONDS. A job
+    whose worker died is queued again after JOB_STALE_SECONDS, and failed
+    once it has been started JOB_MAX_ATTEMPTS times. A job whose handler
+    raises fails straight away, it is not retried.
+
+    Files go through the job_files table rather than a disk, since the web
+    and worker processes need not share one (on Heroku each dyno has its
+    own): POST /jobs stores an import's uploads with the job, and an export
+    stores its results there for GET /jobs/<id>/files/<name>. Inputs are
+    deleted once the job has finished; finished jobs and their outputs are
+    deleted after JOB_RETENTION_HOURS by the workers (or `manage.py
+    expire_jobs`).
+
+Kinds
+    export      params: format, tables, batch_size. Stores one file per table.
+    import      params: actors, movies, performances (set from the uploaded
+                files of those names), batch_size, show_errors.
+    reconcile   no params; see models.py, Denormalized Counters.
+    purge       params: older_than_hours, batch_size; see models.py, Soft Delete.
+'''
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed')
+
+
+class JobKind(object):
+    def __init__(self, permissions, parse, run, inputs=()):
+        # Every permission is needed to queue a job of this kind.
+        self.permissions = permissions
+        # Names of the files a job of this kind can be given in POST /jobs.
+        self.inputs = inputs
+        # Validates the request's params, raising ValueError, and returns
+        # them with their defaults filled in.
+        self.parse = parse
+        # run(job_id, params, progress) -> JSON-serialisable result
+        self.run = run
+
+
+class JobProgress(object):
+    '''
+    The `report` callable handed to a job's handler. Lines are only kept in
+    memory; step() stores the progress and the last line. It writes on its
+    own connection so as not to commit the handler's work, and is only
+    called between the handler's transactions, which on SQLite would block
+    it.
+    '''
+
+    def __init__(self, job_id, total=1):
+        self.job_id = job_id
+        self.total = total
+        self.done = 0
+        self.message = None
+        self.beaten_at = datetime.utcnow()
+        self.beat_every = timedelta(seconds=JOB_HEARTBEAT_SECONDS)
+
+    def __call__(self, message):
+        self.message = message
+
+    def beat(self):
+        '''
+        Marks the job alive from inside the handler's transaction, for
+        handlers holding one open for long (an import file). On SQLite that
+        transaction holds the write lock, so the worker's heartbeat thread
+        cannot write until it commits and the job would look stale to the
+        other workers meanwhile; this update commits with the handler's
+        work instead, so the job is fresh the moment the lock is released.
+        On Postgres the heartbeat thread is not blocked, and updating the
+        row here would lock it against that thread until the commit.
+        '''
+        now = datetime.utcnow()
+
+        if db.engine.dialect.name != 'sqlite' or now < self.beaten_at + self.beat_every:
+            return
+
+        jobs = Job.__table__
+        db.session.execute(jobs.update().where(jobs.c.id == self.job_id).values(heartbeat_at=now))
+        self.beaten_at = now
+
+    def step(self, message=None):
+        self.done += 1
+        if message is not None:
+            self.message = message
+
+        jobs = Job.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                jobs.update().where(jobs.c.id == self.job_id).values(
+                    progress=round(min(self.done / self.total, 1), 4),
+                    message=self.message,
+                    heartbeat_at=datetime.utcnow()
+                )
+            )
+
+
+# ---------------------------------------------------------------------------- #
+# Job Kinds                                                                    #
+# ---------------------------------------------------------------------------- #
+
+def _positive_int(params, name, default):
+    value = params.get(name, default)
+
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError('{} must be a positive integer.'.format(name))
+
+    return value
+
+
+def parse_export(params):
+    fmt = params.get('format') or export.default_format()
+    tables = params.get('tables') or list(EXPORT_TABLES)
+
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('format must be one of {}.'.format(', '.join(EXPORT_FORMATS)))
+    if fmt != 'csv' and not export.has_pyarrow():
+        raise ValueError('{} export needs pyarrow; use csv.'.format(fmt))
+    if not isinstance(tables, list) or not set(tables) <= set(EXPORT_TABLES):
+        raise ValueError('tables must be a list of {}.'.format(', '.join(EXPORT_TABLES)))
+
+    return {
+        'format': fmt,
+        'tables': tables,
+        'batch_size': _positive_int(params, 'batch_size', EXPORT_BATCH_SIZE)
+    }
+
+
+def run_export(job_id, params, progress):
+    progress.total = len(params['tables'])
+    # A job run again after its worker died starts over.
+    delete_files(job_id, 'output')
+    files = []
+
+    with tempfile.TemporaryDirectory(prefix='export-') as out_dir:
+        written = export_catalog(out_dir, params['format'], params['batch_size'],
+                                 params['tables'], report=progress.step)
+
+        for name, path, rows in written:
+            with open(path, 'rb') as source:
+                store_file(job_id, 'output', os.path.basename(path), source)
+            commit()
+            files.append({'table': name, 'file': os.path.basename(path), 'rows': rows})
+
+    return {'files': files}
+
+
+IMPORT_FILES = ('actors', 'movies', 'performances')
+IMPORT_SUFFIXES = ('.csv', '.ndjson', '.jsonl', '.csv.gz', '.ndjson.gz', '.jsonl.gz')
+
+
+def import_file_name(name, filename):
+    '''
+    The name an uploaded file is stored under: the file's name (actors,
+    movies or performances) with the upload's suffix, which bulk_import
+    reads the format from.
+    '''
+    for suffix in IMPORT_SUFFIXES:
+        if (filename or '').endswith(suffix):
+            return name + suffix
+
+    raise ValueError('{} must be one of {}.'.format(name, ', '.join(IMPORT_SUFFIXES)))
+
+
+def parse_import(params):
+    files = {name: params[name] for name in IMPORT_FILES if params.get(name)}
+
+    if not files:
+        raise ValueError('no file to import; upload one of {}.'.format(', '.join(IMPORT_FILES)))
+
+    for name, filename in files.items():
+        if import_file_name(name, filename) != filename:
+            raise ValueError('{} is not an uploaded {} file.'.format(filename, name))
+
+    return dict(files,
+                batch_size=_positive_int(params, 'batch_size', IMPORT_BATCH_SIZE),
+                show_errors=_positive_int(params, 'show_errors', 20))
+
+
+def run_import(job_id, params, progress):
+    files = [name for name in IMPORT_FILES if params.get(name)]
+    progress.total = len(files)
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='import-') as in_dir:
+        # One file per call, in the order bulk_import uses, so that progress
+        # advances as each file is committed.
+        for name in files:
+            path = os.path.join(in_dir, params[name])
+            parts = file_parts(job_id, 'input', params[name])
+
+            if not parts:
+                raise ValueError('{} was not uploaded with the job.'.format(params[name]))
+
+            with open(path, 'wb') as target:
+                for content in read_file(parts):
+                    target.write(content)
+
+            imported = bulk_import(batch_size=params['batch_size'], show_errors=params['show_errors'],
+                                   report=progress, on_batch=progress.beat, **{name: path})
+            rows, rejected = imported[name]
+            results[name] = {'rows': rows, 'rejected': rejected}
+            progress.step()
+
+    return results
+
+
+def parse_reconcile(params):
+    return {}
+
+
+def run_reconcile(job_id, params, progress):
+    movies, actors = reconcile_counters()
+    return {'movies_repaired': movies, 'actors_repaired': actors}
+
+
+def parse_purge(params):
+    older_than_hours = params.get('older_than_hours', 0)
+
+    if not isinstance(older_than_hours, (int, float)) or isinstance(older_than_hours, bool) \
+            or older_than_hours < 0:
+        raise ValueError('older_than_hours must be a number of hours.')
+
+    return {
+        'older_than_hours': older_than_hours,
+        'batch_size': _positive_int(params, 'batch_size', PURGE_BATCH_SIZE)
+    }
+
+
+def run_purge(job_id, params, progress):
+    # purge_deleted reports once for movies and once for actors.
+    progress.total = 2
+    older_than = datetime.utcnow() - timedelta(hours=params['older_than_hours'])
+    return {'purged': purge_deleted(older_than, params['batch_size'], report=progress.step)}
+
+
+JOB_KINDS = {
+    'export': JobKind(('read:actors', 'read:movies'), parse_export, run_export),
+    'import': JobKind(('create:actors', 'create:movies', 'edit:movies'), parse_import, run_import,
+                      inputs=IMPORT_FILES),
+    'reconcile': JobKind(('edit:actors', 'edit:movies'), parse_reconcile, run_reconcile),
+    'purge': JobKind(('delete:actors', 'delete:movies'), parse_purge, run_purge)
+}
+
+
+# ---------------------------------------------------------------------------- #
+# Job Files                                                                    #
+# ---------------------------------------------------------------------------- #
+
+def store_file(job_id, role, name, source):
+    '''Copies a binary file object into job_files, one part at a time, in the current session.'''
+    files = JobFile.__table__
+    part = 0
+
+    while True:
+        content = source.read(JOB_FILE_PART_BYTES)
+
+        # An empty file is stored as one empty part, so that it exists.
+        if not content and part:
+            break
+
+        db.session.execute(files.insert().values(job_id=job_id, role=role, name=name,
+                                                 part=part, content=content))
+        part += 1
+
+        if len(content) < JOB_FILE_PART_BYTES:
+            break
+
+
+def file_parts(job_id, role, name):
+    '''The ids of a stored file's parts, in order; empty if there is no such file.'''
+    files = JobFile.__table__
+    return [part_id for (part_id,) in db.session.execute(
+        select([files.c.id])
+        .where(and_(files.c.job_id == job_id, files.c.role == role, files.c.name == name))
+        .order_by(files.c.part)
+    )]
+
+
+def read_file(part_ids):
+    '''Yields the content of each part, loading one part at a time.'''
+    files = JobFile.__table__
+    for part_id in part_ids:
+        yield db.session.execute(select([files.c.content]).where(files.c.id == part_id)).scalar()
+
+
+def delete_files(job_id, role):
+    files = JobFile.__table__
+    db.session.execute(files.delete().where(and_(files.c.job_id == job_id, files.c.role == role)))
+    commit()
+
+
+def expire_jobs(older_than_hours=JOB_RETENTION_HOURS):
+    '''Deletes jobs that finished more than older_than_hours ago, with their files; returns how many.'''
+    jobs = Job.__table__
+    files = JobFile.__table__
+    expired = select([jobs.c.id]).where(and_(
+        jobs.c.status.in_(('succeeded', 'failed')),
+        jobs.c.finished_at < datetime.utcnow() - timedelta(hours=older_than_hours)
+    ))
+
+    with db.engine.begin() as connection:
+        job_ids = [job_id for (job_id,) in connection.execute(expired)]
+
+        if job_ids:
+            connection.execute(files.delete().where(files.c.job_id.in_(job_ids)))
+            connection.execute(jobs.delete().where(jobs.c.id.in_(job_ids)))
+
+    return len(job_ids)
+
+
+# ---------------------------------------------------------------------------- #
+# Queue                                                                        #
+# ---------------------------------------------------------------------------- #
+
+def enqueue(kind, params, subject=None, inputs=None):
+    '''
+    Queues a job; params must already have been through its kind's parse().
+    inputs maps file names to binary file objects stored with the job.
+    '''
+    job = Job(kind=kind, params=json.dumps(params), status='queued', progress=0,
+              subject=subject, attempts=0)
+    db.session.add(job)
+    db.session.flush()
+
+    for name, source in (inputs or {}).items():
+        store_file(job.id, 'input', name, source)
+
+    commit()
+    return job
+
+
+def claim_next(worker):
+    '''Marks the oldest queued job as running for `worker`; returns its id, or None.'''
+    jobs = Job.__table__
+
+    while True:
+        with db.engine.begin() as connection:
+            candidate = select([jobs.c.id]).where(jobs.c.status == 'queued').order_by(jobs.c.id).limit(1)
+
+            if connection.dialect.name == 'postgresql':
+                candidate = candidate.with_for_update(skip_locked=True)
+
+            job_id = connection.execute(candidate).scalar()
+
+            if job_id is None:
+                return None
+
+            now = datetime.utcnow()
+            claimed = connection.execute(
+                jobs.update()
+                .where(and_(jobs.c.id == job_id, jobs.c.status == 'queued'))
+                .values(status='running', worker=worker, attempts=jobs.c.attempts + 1,
+                        started_at=now, heartbeat_at=now)
+            ).rowcount
+
+        # Lost the race for this job to another worker (SQLite); try the next.
+        if claimed:
+            return job_id
+
+
+def finish(job_id, worker, status, result=None, error=None):
+    jobs = Job.__table__
+    values = {'status': status, 'error': error, 'finished_at': datetime.utcnow()}
+
+    if status == 'succeeded':
+        values.update(progress=1, result=json.dumps(result, default=str))
+
+    with db.engine.begin() as connection:
+        # A job requeued while its worker was presumed dead belongs to
+        # whichever worker claimed it since.
+        finished = connection.execute(
+            jobs.update()
+            .where(and_(jobs.c.id == job_id, jobs.c.worker == worker, jobs.c.status == 'running'))
+            .values(**values)
+        ).rowcount
+
+        # Its uploads are not needed any more; outputs stay until expire_jobs.
+        if finished:
+            files = JobFile.__table__
+            connection.execute(files.delete().where(and_(files.c.job_id == job_id, files.c.role == 'input')))
+
+
+def run_job(job_id, worker):
+    job = Job.query.get(job_id)
+
+    try:
+        result = JOB_KINDS[job.kind].run(job_id, json.loads(job.params), JobProgress(job_id))
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('job %s (%s) failed', job_id, job.kind)
+        finish(job_id, worker, 'failed', error='{}: {}'.format(type(e).__name__, e))
+    else:
+        finish(job_id, worker, 'succeeded', result=result)
+    finally:
+        db.session.remove()
+
+
+def keep_alive(worker_prefix):
+    '''Marks this process's running jobs alive and requeues those of dead workers.'''
+    jobs = Job.__table__
+    now = datetime.utcnow()
+    stale = and_(jobs.c.status == 'running', jobs.c.heartbeat_at < now - timedelta(seconds=JOB_STALE_SECONDS))
+
+    with db.engine.begin() as connection:
+        connection.execute(
+            jobs.update()
+            .where(and_(jobs.c.status == 'running', jobs.c.worker.startswith(worker_prefix)))
+            .values(heartbeat_at=now)
+        )
+        connection.execute(
+            jobs.update().where(and_(stale, jobs.c.attempts < JOB_MAX_ATTEMPTS))
+            .values(status='queued', worker=None)
+        )
+        connection.execute(
+            jobs.update().where(and_(stale, jobs.c.attempts >= JOB_MAX_ATTEMPTS))
+            .values(status='failed', error='worker lost', finished_at=now)
+        )
+
+
+# ---------------------------------------------------------------------------- #
+# Worker                                                                       #
+# ---------------------------------------------------------------------------- #
+
+def run_worker(app, concurrency=JOB_WORKER_CONCURRENCY, poll_seconds=JOB_POLL_SECONDS, burst=False):
+    '''
+    Runs queued jobs on `concurrency` threads until interrupted or, with
+    burst, until the queue is empty.
+    '''
+    worker_prefix = '{}:{}:'.format(socket.gethostname(), os.getpid())
+    stop = threading.Event()
+
+    def work(number):
+        worker = worker_prefix + str(number)
+
+        # Each thread has its own app context and so its own session.
+        with app.app_context():
+            while not stop.is_set():
+                job_id = claim_next(worker)
+
+                if job_id is not None:
+                    run_job(job_id, worker)
+                elif burst:
+                    return
+                else:
+                    stop.wait(poll_seconds)
+
+    def beat():
+        with app.app_context():
+            while not stop.wait(JOB_HEARTBEAT_SECONDS):
+                try:
+                    keep_alive(worker_prefix)
+                    expire_jobs()
+                except Exception:
+                    # e.g. SQLite locked by a long import; the next beat retries.
+                    logger.exception('job heartbeat failed')
+
+    with app.app_context():
+        keep_alive(worker_prefix)
+
+    threads = [threading.Thread(target=work, args=(number,), daemon=True) for number in range(concurrency)]
+    heartbeat = threading.Thread(target=beat, daemon=True)
+
+    for thread in threads:
+        thread.start()
+    heartbeat.start()
+
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        # Jobs in progress die with the process and are queued again once
+        # they have not been marked alive for JOB_STALE_SECONDS.
+        pass
+    finally:
+        stop.set()
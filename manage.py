@@ -1,15 +1,149 @@
-from flask_script import Manager
+from flask_script import (
+    Manager,
+    Command,
+    Option
+)
 from flask_migrate import (
     Migrate,
     MigrateCommand
 )
-from app import app
-from models import db
+import json
+import os
+from datetime import datetime, timedelta
+from urllib.request import urlopen
+from app import create_app
+from auth import (
+    AUTH0_DOMAIN,
+    jwks_url
+)
+from models import (
+    db,
+    create_all,
+    reconcile_counters as reconcile_all_counters,
+    purge_deleted,
+    IdempotencyKey
+)
+from bulk_import import bulk_import
+from jobs import (
+    run_worker,
+    expire_jobs as expire_finished_jobs
+)
+from export import (
+    EXPORT_FORMATS,
+    EXPORT_TABLES,
+    export_catalog
+)
+from config import (
+    IDEMPOTENCY_KEY_TTL_HOURS,
+    EXPORT_BATCH_SIZE,
+    IMPORT_BATCH_SIZE,
+    PURGE_BATCH_SIZE,
+    JOB_WORKER_CONCURRENCY,
+    JOB_POLL_SECONDS,
+    JOB_RETENTION_HOURS
+)
+
+app = create_app()
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+class ImportCommand(Command):
+    '''Bulk-load actors, movies and performances from CSV/NDJSON files.'''
+
+    option_list = (
+        Option('--actors', dest='actors', help='CSV/NDJSON file (.gz ok) with name, age, gender'),
+        Option('--movies', dest='movies', help='CSV/NDJSON file (.gz ok) with title, release_date'),
+        Option('--performances', dest='performances',
+               help='CSV/NDJSON file (.gz ok) with movie_id|movie_title, actor_id|actor_name, actor_fee'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=IMPORT_BATCH_SIZE),
+        Option('--show-errors', dest='show_errors', type=int, default=100,
+               help='number of rejected rows to print per file'),
+    )
+
+    def run(self, actors, movies, performances, batch_size, show_errors):
+        bulk_import(actors, movies, performances, batch_size, show_errors)
+
+
+manager.add_command('import', ImportCommand())
+
+
+@manager.command
+def create_db():
+    '''Create any missing tables. Run once per deploy, not per worker, before `db upgrade`.'''
+    create_all()
+
+
+
+@manager.command
+def expire_idempotency_keys():
+    '''Delete stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL_HOURS.'''
+    cutoff = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_KEY_TTL_HOURS)
+    deleted = IdempotencyKey.query.filter(IdempotencyKey.created_at < cutoff).delete()
+    db.session.commit()
+    print('deleted {} idempotency keys'.format(deleted))
+
+
+
+@manager.command
+def reconcile_counters():
+    '''Recompute cast_count, total_fee and movie_count from Performance and repair drifted rows.'''
+    movies, actors = reconcile_all_counters()
+    print('repaired counters of {} movies and {} actors'.format(movies, actors))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=PURGE_BATCH_SIZE)
+@manager.option('--older-than-hours', dest='older_than_hours', type=float, default=0,
+                help='only purge rows deleted at least this long ago')
+def purge(batch_size, older_than_hours):
+    '''Remove deleted actors and movies and their Performance rows, in batches.'''
+    purge_deleted(datetime.utcnow() - timedelta(hours=older_than_hours), batch_size)
+
+
+@manager.option('-o', '--out-dir', dest='out_dir', default='export')
+@manager.option('-f', '--format', dest='fmt', choices=EXPORT_FORMATS, default=None,
+                help='parquet (default when pyarrow is installed), arrow or csv')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=EXPORT_BATCH_SIZE)
+@manager.option('-t', '--table', dest='tables', action='append', choices=list(EXPORT_TABLES),
+                help='export only this table (repeatable)')
+def export(out_dir, fmt, batch_size, tables):
+    '''Export actors, movies and Performance as columnar files.'''
+    export_catalog(out_dir, fmt, batch_size, tables)
+
+
+
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=JOB_WORKER_CONCURRENCY,
+                help='jobs run at a time by this process')
+@manager.option('-p', '--poll-seconds', dest='poll_seconds', type=float, default=JOB_POLL_SECONDS)
+@manager.option('--burst', dest='burst', action='store_true', help='exit once the queue is empty')
+def worker(concurrency, poll_seconds, burst):
+    '''Run background jobs queued by POST /jobs.'''
+    run_worker(app, concurrency, poll_seconds, burst)
+
+
+@manager.option('--older-than-hours', dest='older_than_hours', type=float, default=JOB_RETENTION_HOURS)
+def expire_jobs(older_than_hours):
+    '''Delete finished jobs older than JOB_RETENTION_HOURS and their stored files.'''
+    print('deleted {} jobs'.format(expire_finished_jobs(older_than_hours)))
+
+
+@manager.option('-o', '--out', dest='out', default='jwks.json')
+@manager.option('-d', '--domain', dest='domain', default=AUTH0_DOMAIN)
+def fetch_jwks(out, domain):
+    '''Save the identity provider's signing keys for offline verification (JWKS_FILE).'''
+    jwks = json.loads(urlopen(jwks_url(domain)).read())
+
+    # Written to a temporary file and renamed, so a running worker reloading
+    # the file never reads it half-written.
+    with open(out + '.tmp', 'w') as target:
+        json.dump(jwks, target, indent=2)
+    os.replace(out + '.tmp', out)
+
+    print('saved {} keys from {} to {}'.format(len(jwks['keys']), domain, out))
+
+
 if __name__ == '__main__':
     manager.run()
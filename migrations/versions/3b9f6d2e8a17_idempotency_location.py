@@ -0,0 +1,29 @@
+"""idempotency_keys.location, replayed with the stored response
+
+Revision ID: 3b9f6d2e8a17
+Revises: c7e95b1f0a42
+Create Date: 2026-10-20 10:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9f6d2e8a17'
+down_revision = 'c7e95b1f0a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('idempotency_keys')}
+    if 'location' in columns:
+        return
+
+    op.add_column('idempotency_keys', sa.Column('location', sa.String(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('idempotency_keys') as batch_op:
+        batch_op.drop_column('location')
@@ -0,0 +1,85 @@
+"""release_date index, denormalized counters, tombstones and Performance indexes
+
+Adds to the tables that existed before `manage.py create_db` took over
+schema creation: the movies.release_date index, movies.cast_count,
+movies.total_fee and actors.movie_count (filled from Performance),
+actors/movies.deleted_at and the Performance foreign key indexes. Each is
+skipped when it already exists, e.g. in tables created by `create_db` in the
+same deploy.
+
+Revision ID: 5a3c1e7d9b20
+Revises:
+Create Date: 2026-10-19 19:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a3c1e7d9b20'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def has_column(table, column):
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def has_index(table, index):
+    return index in {i['name'] for i in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def create_index(name, table, columns):
+    if not has_index(table, name):
+        op.create_index(name, table, columns)
+
+
+def upgrade():
+    # Tables made by `manage.py create_db` already have everything below;
+    # only what is missing is added.
+    create_index('ix_movies_release_date', 'movies', ['release_date'])
+
+    if not has_column('movies', 'cast_count'):
+        op.add_column('movies', sa.Column('cast_count', sa.Integer(), nullable=False, server_default='0'))
+        op.add_column('movies', sa.Column('total_fee', sa.Float(), nullable=False, server_default='0'))
+        op.execute(
+            'UPDATE movies SET '
+            'cast_count = (SELECT count(*) FROM "Performance" WHERE "Movie_id" = movies.id), '
+            'total_fee = (SELECT coalesce(sum(actor_fee), 0) FROM "Performance" WHERE "Movie_id" = movies.id)'
+        )
+
+    if not has_column('actors', 'movie_count'):
+        op.add_column('actors', sa.Column('movie_count', sa.Integer(), nullable=False, server_default='0'))
+        op.execute(
+            'UPDATE actors SET '
+            'movie_count = (SELECT count(*) FROM "Performance" WHERE "Actor_id" = actors.id)'
+        )
+
+    if not has_column('movies', 'deleted_at'):
+        op.add_column('movies', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    if not has_column('actors', 'deleted_at'):
+        op.add_column('actors', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    create_index('ix_movies_deleted_at', 'movies', ['deleted_at'])
+    create_index('ix_actors_deleted_at', 'actors', ['deleted_at'])
+
+    create_index('ix_Performance_Movie_id', 'Performance', ['Movie_id'])
+    create_index('ix_Performance_Actor_id', 'Performance', ['Actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_Performance_Actor_id', table_name='Performance')
+    op.drop_index('ix_Performance_Movie_id', table_name='Performance')
+    op.drop_index('ix_actors_deleted_at', table_name='actors')
+    op.drop_index('ix_movies_deleted_at', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+
+    with op.batch_alter_table('actors') as batch_op:
+        batch_op.drop_column('deleted_at')
+        batch_op.drop_column('movie_count')
+
+    with op.batch_alter_table('movies') as batch_op:
+        batch_op.drop_column('deleted_at')
+        batch_op.drop_column('total_fee')
+        batch_op.drop_column('cast_count')
@@ -0,0 +1,68 @@
+"""unique (Movie_id, Actor_id) on Performance
+
+Removes duplicate castings left by concurrent casting requests, keeping one
+row per pair, recomputes the counters they inflated and adds the unique
+index that cast_actors relies on. Skipped when the index already exists.
+
+Revision ID: 8c41f2a6d3e5
+Revises: 5a3c1e7d9b20
+Create Date: 2026-10-19 19:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41f2a6d3e5'
+down_revision = '5a3c1e7d9b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+
+    # A Performance table created by `manage.py create_db` has the index and
+    # so no duplicates.
+    indexes = {index['name'] for index in sa.inspect(connection).get_indexes('Performance')}
+    if 'uq_Performance_Movie_id_Actor_id' in indexes:
+        return
+
+    duplicates = connection.execute(sa.text(
+        'SELECT "Movie_id", "Actor_id" FROM "Performance" '
+        'GROUP BY "Movie_id", "Actor_id" HAVING count(*) > 1'
+    )).fetchall()
+
+    for movie_id, actor_id in duplicates:
+        pair = {'movie_id': movie_id, 'actor_id': actor_id}
+        actor_fee = connection.execute(sa.text(
+            'SELECT actor_fee FROM "Performance" WHERE "Movie_id" = :movie_id AND "Actor_id" = :actor_id'
+        ), pair).first()[0]
+        connection.execute(sa.text(
+            'DELETE FROM "Performance" WHERE "Movie_id" = :movie_id AND "Actor_id" = :actor_id'
+        ), pair)
+        connection.execute(sa.text(
+            'INSERT INTO "Performance" ("Movie_id", "Actor_id", actor_fee) VALUES (:movie_id, :actor_id, :actor_fee)'
+        ), dict(pair, actor_fee=actor_fee))
+
+    if duplicates:
+        # Only castings whose actor and movie are both live are counted.
+        op.execute(
+            'UPDATE movies SET '
+            'cast_count = (SELECT count(*) FROM "Performance" p JOIN actors a ON a.id = p."Actor_id" '
+            'WHERE p."Movie_id" = movies.id AND a.deleted_at IS NULL), '
+            'total_fee = (SELECT coalesce(sum(p.actor_fee), 0) FROM "Performance" p JOIN actors a ON a.id = p."Actor_id" '
+            'WHERE p."Movie_id" = movies.id AND a.deleted_at IS NULL)'
+        )
+        op.execute(
+            'UPDATE actors SET '
+            'movie_count = (SELECT count(*) FROM "Performance" p JOIN movies m ON m.id = p."Movie_id" '
+            'WHERE p."Actor_id" = actors.id AND m.deleted_at IS NULL)'
+        )
+
+    op.create_index('uq_Performance_Movie_id_Actor_id', 'Performance', ['Movie_id', 'Actor_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_Performance_Movie_id_Actor_id', table_name='Performance')
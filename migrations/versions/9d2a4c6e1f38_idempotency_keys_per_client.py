@@ -0,0 +1,71 @@
+"""idempotency_keys keyed by (subject, key)
+
+Scopes stored Idempotency-Key responses to the client that sent them:
+the primary key becomes (subject, key). Rows without a subject are given
+the `anonymous` client id. A table created by `manage.py create_db` in
+the same deploy already has the new key and is left alone.
+
+Revision ID: 9d2a4c6e1f38
+Revises: 3b9f6d2e8a17
+Create Date: 2026-10-20 11:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2a4c6e1f38'
+down_revision = '3b9f6d2e8a17'
+branch_labels = None
+depends_on = None
+
+
+def primary_key():
+    return sa.inspect(op.get_bind()).get_pk_constraint('idempotency_keys')
+
+
+def set_primary_key(columns):
+    old = primary_key()
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint(old['name'], 'idempotency_keys', type_='primary')
+        op.alter_column('idempotency_keys', 'subject', existing_type=sa.String(),
+                        nullable='subject' not in columns)
+        op.create_primary_key('pk_idempotency_keys', 'idempotency_keys', columns)
+        return
+
+    # SQLite cannot alter a primary key; the table is copied instead.
+    names = 'subject, key, method, path, status_code, response, location, created_at'
+    op.create_table(
+        'idempotency_keys_new',
+        sa.Column('subject', sa.String(), nullable='subject' not in columns),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('method', sa.String()),
+        sa.Column('path', sa.String()),
+        sa.Column('status_code', sa.Integer()),
+        sa.Column('response', sa.Text()),
+        sa.Column('location', sa.String()),
+        sa.Column('created_at', sa.DateTime()),
+        sa.PrimaryKeyConstraint(*columns, name='pk_idempotency_keys')
+    )
+    op.execute('INSERT INTO idempotency_keys_new ({0}) SELECT {0} FROM idempotency_keys'.format(names))
+    op.drop_table('idempotency_keys')
+    op.rename_table('idempotency_keys_new', 'idempotency_keys')
+
+
+def upgrade():
+    if primary_key()['constrained_columns'] == ['subject', 'key']:
+        return
+
+    op.execute("UPDATE idempotency_keys SET subject = 'anonymous' WHERE subject IS NULL")
+    set_primary_key(['subject', 'key'])
+
+
+def downgrade():
+    # Keys used by several clients cannot keep one row each.
+    op.execute(
+        'DELETE FROM idempotency_keys WHERE key IN '
+        '(SELECT key FROM idempotency_keys GROUP BY key HAVING count(*) > 1)'
+    )
+    set_primary_key(['key'])
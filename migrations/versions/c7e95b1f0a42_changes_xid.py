@@ -0,0 +1,41 @@
+"""changes.xid for commit-safe paging of GET /changes
+
+Adds the id of the writing transaction to the change log. Existing rows
+are all committed; on Postgres they get xid 0 so that they page first, in
+seq order. A changes table created by `manage.py create_db` in the same
+deploy already has the column and is left alone.
+
+Revision ID: c7e95b1f0a42
+Revises: 8c41f2a6d3e5
+Create Date: 2026-10-19 20:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e95b1f0a42'
+down_revision = '8c41f2a6d3e5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('changes')}
+    if 'xid' in columns:
+        return
+
+    op.add_column('changes', sa.Column('xid', sa.BigInteger(), nullable=True))
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('UPDATE changes SET xid = 0')
+
+    op.create_index('ix_changes_xid_seq', 'changes', ['xid', 'seq'])
+
+
+def downgrade():
+    op.drop_index('ix_changes_xid_seq', table_name='changes')
+
+    with op.batch_alter_table('changes') as batch_op:
+        batch_op.drop_column('xid')
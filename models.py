@@ -1,13 +1,37 @@
-from datetime import date
+import json
+from datetime import date, datetime, timedelta
 from sqlalchemy import (
+    event,
+    and_,
+    or_,
+    func,
+    bindparam,
+    select,
     Column,
     String,
     Integer,
+    BigInteger,
     Date,
-    Float
+    DateTime,
+    Float,
+    LargeBinary,
+    Text
+)
+from sqlalchemy.orm import lazyload
+from flask import (
+    g,
+    has_request_context
 )
 from flask_sqlalchemy import SQLAlchemy
-from config import DATABASE_URL
+from cache import LRUCache
+from config import (
+    DATABASE_URL,
+    ENTITY_CACHE_SIZE,
+    ENTITY_CACHE_TTL,
+    MULTI_GET_CHUNK_SIZE,
+    RELEASE_CALENDAR_CACHE_TTL,
+    PURGE_BATCH_SIZE
+)
 
 
 # ---------------------------------------------------------------------------- #
@@ -17,7 +41,19 @@ from config import DATABASE_URL
 database_path = DATABASE_URL
 
 
-db = SQLAlchemy()
+# Objects keep their loaded state after commit: views format them right
+# after writing and a session only lives for one request, so expiring them
+# would just cost a SELECT per object.
+db = SQLAlchemy(session_options={'expire_on_commit': False})
+
+# Formatted actors/movies by primary key, for GET /actors/<id> and
+# GET /movies/<id>. Invalidated once a write to the record has committed.
+actor_cache = LRUCache(maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+movie_cache = LRUCache(maxsize=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL)
+
+# Release counts per calendar bucket, one entry per granularity, for
+# GET /movies/calendar. Cleared once any movie write has committed.
+release_calendar_cache = LRUCache(maxsize=3, ttl=RELEASE_CALENDAR_CACHE_TTL)
 
 
 def setup_db(app, database_path=DATABASE_URL):
@@ -25,9 +61,65 @@ def setup_db(app, database_path=DATABASE_URL):
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
+
+
+def create_all():
+    '''
+    Create any missing tables. Kept out of setup_db so that importing the app
+    or starting a worker never issues DDL; run `python manage.py create_db`
+    once per deploy instead. Columns and indexes added to tables that already
+    exist come from the Alembic revisions in migrations/
+    (`python manage.py db upgrade`).
+    '''
     db.create_all()
 
 
+def insert_ignore(table):
+    '''
+    INSERT that silently skips rows violating a unique constraint:
+    `ON CONFLICT DO NOTHING` on Postgres, `INSERT OR IGNORE` on SQLite.
+    The result's rowcount tells the caller whether the row was written.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def commit():
+    '''
+    Commits the session, unless the current request runs as a unit of work
+    (UNIT_OF_WORK, see create_app): then the changes are only flushed, and the
+    request commits once after the view has returned.
+    '''
+    if has_request_context() and g.get('unit_of_work'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def invalidate_on_commit(cache, key=None):
+    '''
+    Drops a cache entry once the current transaction has committed; without
+    a key the whole cache is cleared.
+    '''
+    db.session.info.setdefault('pending_invalidations', set()).add((cache, key))
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_invalidations(session):
+    for cache, key in session.info.pop('pending_invalidations', ()):
+        if key is None:
+            cache.clear()
+        else:
+            cache.invalidate(key)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_invalidations(session):
+    session.info.pop('pending_invalidations', None)
+
 
 def db_drop_and_create_all():
     db.drop_all()
@@ -64,12 +156,163 @@ def db_init():
 # ---------------------------------------------------------------------------- #
 
 Performance = db.Table('Performance', db.Model.metadata,
-                       db.Column('Movie_id', db.Integer, db.ForeignKey('movies.id')),
-                       db.Column('Actor_id', db.Integer, db.ForeignKey('actors.id')),
-                       db.Column('actor_fee', db.Float)
+                       db.Column('Movie_id', db.Integer, db.ForeignKey('movies.id'), index=True),
+                       db.Column('Actor_id', db.Integer, db.ForeignKey('actors.id'), index=True),
+                       db.Column('actor_fee', db.Float),
+                       # An actor is cast in a movie at most once; cast_actors relies on it.
+                       db.Index('uq_Performance_Movie_id_Actor_id', 'Movie_id', 'Actor_id', unique=True)
                        )
 
 
+
+'''
+Casting helpers
+    Set-based writes to Performance. They never load Movie.actors; casting
+    n actors costs one SELECT of the existing rows plus one INSERT (one per
+    actor on SQLite), not n ORM flushes. Each also adjusts the movie's and
+    actors' counters (see Denormalized Counters).
+
+    cast_actors inserts through insert_ignore(): when concurrent requests
+    cast the same actor, the unique (Movie_id, Actor_id) index lets only one
+    row in, and the counters and change log only see the rows that were
+    actually written.
+
+    fees maps actor id -> actor_fee.
+'''
+
+
+def existing_actor_ids(actor_ids):
+    rows = db.session.execute(
+        select([Actor.id]).where(and_(Actor.id.in_(actor_ids), Actor.deleted_at.is_(None)))
+    )
+    return {row[0] for row in rows}
+
+
+def cast_fees(movie_id, actor_ids):
+    '''
+    {actor id: actor_fee} of the given actors that are cast in the movie.
+    Deleted actors are left out: their castings no longer count (see Soft
+    Delete) and can only be removed by purge.
+    '''
+    actors = Actor.__table__
+    rows = db.session.execute(
+        select([Performance.c.Actor_id, Performance.c.actor_fee])
+        .select_from(Performance.join(actors, actors.c.id == Performance.c.Actor_id))
+        .where(and_(
+            Performance.c.Movie_id == movie_id,
+            Performance.c.Actor_id.in_(actor_ids),
+            actors.c.deleted_at.is_(None)
+        ))
+    )
+    return {row[0]: row[1] for row in rows}
+
+
+def cast_actors(movie_id, fees):
+    already_cast = cast_fees(movie_id, list(fees))
+    rows = [
+        {'Movie_id': movie_id, 'Actor_id': actor_id, 'actor_fee': fee}
+        for actor_id, fee in fees.items() if actor_id not in already_cast
+    ]
+
+    inserted = insert_new_castings(rows)
+
+    if inserted:
+        record_changes([performance_change('insert', row) for row in inserted])
+        adjust_counters(
+            {movie_id: (len(inserted), sum(row['actor_fee'] or 0 for row in inserted))},
+            {row['Actor_id']: 1 for row in inserted}
+        )
+    commit()
+
+    cast = [row['Actor_id'] for row in inserted]
+    # Actors cast by a concurrent request between the SELECT and the INSERT.
+    lost = [row['Actor_id'] for row in rows if row['Actor_id'] not in cast]
+
+    return cast, sorted(list(already_cast) + lost)
+
+
+def insert_new_castings(rows):
+    '''Inserts the rows that are not in Performance yet and returns those.'''
+    if not rows:
+        return []
+
+    if db.engine.dialect.name == 'postgresql':
+        statement = insert_ignore(Performance).values(rows).returning(Performance.c.Actor_id)
+        written = {row[0] for row in db.session.execute(statement)}
+        return [row for row in rows if row['Actor_id'] in written]
+
+    statement = insert_ignore(Performance)
+    return [row for row in rows if db.session.execute(statement, row).rowcount]
+
+
+def update_actor_fees(movie_id, fees):
+    cast = cast_fees(movie_id, list(fees))
+    rows = [
+        {'b_actor_id': actor_id, 'b_actor_fee': fee}
+        for actor_id, fee in fees.items() if actor_id in cast
+    ]
+
+    if rows:
+        db.session.execute(
+            Performance.update()
+            .where(and_(
+                Performance.c.Movie_id == movie_id,
+                Performance.c.Actor_id == bindparam('b_actor_id')
+            ))
+            .values(actor_fee=bindparam('b_actor_fee')),
+            rows
+        )
+        record_changes([performance_change('update', {
+            'Movie_id': movie_id,
+            'Actor_id': row['b_actor_id'],
+            'actor_fee': row['b_actor_fee']
+        }) for row in rows])
+        adjust_counters({movie_id: (0, sum(
+            (row['b_actor_fee'] or 0) - (cast[row['b_actor_id']] or 0) for row in rows
+        ))}, {})
+    commit()
+
+    return [row['b_actor_id'] for row in rows], sorted(set(fees) - set(cast))
+
+
+def uncast_actors(movie_id, actor_ids):
+    removed_fees = cast_fees(movie_id, actor_ids)
+    removed = db.session.execute(
+        Performance.delete().where(and_(
+            Performance.c.Movie_id == movie_id,
+            Performance.c.Actor_id.in_(list(removed_fees))
+        ))
+    ).rowcount
+    record_changes([performance_change('delete', {
+        'Movie_id': movie_id,
+        'Actor_id': actor_id
+    }) for actor_id in sorted(removed_fees)])
+    if removed_fees:
+        adjust_counters(
+            {movie_id: (-len(removed_fees), -sum(fee or 0 for fee in removed_fees.values()))},
+            {actor_id: -1 for actor_id in removed_fees}
+        )
+    commit()
+
+    return removed
+
+
+def movie_cast(movie_id):
+    rows = db.session.execute(
+        select([Actor.__table__, Performance.c.actor_fee])
+        .select_from(Actor.__table__.join(Performance, Performance.c.Actor_id == Actor.id))
+        .where(and_(Performance.c.Movie_id == movie_id, Actor.deleted_at.is_(None)))
+        .order_by(Actor.id)
+    )
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'gender': row.gender,
+        'age': row.age,
+        'actor_fee': row.actor_fee
+    } for row in rows]
+
+
 # ---------------------------------------------------------------------------- #
 # Actors Model 																   #
 # ---------------------------------------------------------------------------- #
@@ -81,6 +324,10 @@ class Actor(db.Model):
     name = Column(String)
     gender = Column(String)
     age = Column(Integer)
+    # Number of Performance rows, see Denormalized Counters.
+    movie_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # Tombstone, see Soft Delete.
+    deleted_at = Column(DateTime, index=True)
 
     def __init__(self, name, gender, age):
         self.name = name
@@ -89,21 +336,52 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        invalidate_on_commit(actor_cache, self.id)
+        commit()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        # A tombstone, like DELETE /actors/<id>; the row is removed by purge.
+        type(self).delete_by_id(self.id)
+        db.session.expire(self, ['deleted_at'])
+
+    @classmethod
+    def live(cls):
+        '''Query of the actors that are not deleted; use instead of cls.query.'''
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def update_by_id(cls, actor_id, values):
+        return update_by_id(cls, actor_id, values)
+
+    @classmethod
+    def delete_by_id(cls, actor_id):
+        return delete_by_id(cls, actor_id)
+
+    @classmethod
+    def get_formatted(cls, actor_id):
+        formatted = actor_cache.get(actor_id)
+
+        if formatted is None:
+            actor = cls.live().options(lazyload('performances')).filter(cls.id == actor_id).first()
+
+            if actor is None:
+                return None
+
+            formatted = actor.format()
+            actor_cache.set(actor_id, formatted)
+
+        return formatted
 
     def format(self):
         return {
             'id': self.id,
             'name': self.name,
             'gender': self.gender,
-            'age': self.age
+            'age': self.age,
+            'movie_count': self.movie_count
         }
 
 
@@ -116,7 +394,13 @@ class Movie(db.Model):
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    release_date = Column(Date)
+    release_date = Column(Date, index=True)
+    # Number of Performance rows and sum of their actor_fee, see
+    # Denormalized Counters.
+    cast_count = Column(Integer, nullable=False, default=0, server_default='0')
+    total_fee = Column(Float, nullable=False, default=0, server_default='0')
+    # Tombstone, see Soft Delete.
+    deleted_at = Column(DateTime, index=True)
     actors = db.relationship('Actor', secondary=Performance, backref=db.backref('performances', lazy='joined'))
 
     def __init__(self, title, release_date):
@@ -125,18 +409,637 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit()
 
     def update(self):
-        db.session.commit()
+        invalidate_on_commit(movie_cache, self.id)
+        commit()
 
     def delete(self):
-        db.session.delete(self)
-        db.session.commit()
+        # A tombstone, like DELETE /movies/<id>; the row is removed by purge.
+        type(self).delete_by_id(self.id)
+        db.session.expire(self, ['deleted_at'])
+
+    @classmethod
+    def live(cls):
+        '''Query of the movies that are not deleted; use instead of cls.query.'''
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def update_by_id(cls, movie_id, values):
+        return update_by_id(cls, movie_id, values)
+
+    @classmethod
+    def delete_by_id(cls, movie_id):
+        return delete_by_id(cls, movie_id)
+
+    @classmethod
+    def get_formatted(cls, movie_id):
+        formatted = movie_cache.get(movie_id)
+
+        if formatted is None:
+            movie = cls.live().options(lazyload('*')).filter(cls.id == movie_id).first()
+
+            if movie is None:
+                return None
+
+            formatted = movie.format()
+            movie_cache.set(movie_id, formatted)
+
+        return formatted
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
-            'release_date': self.release_date
+            'release_date': self.release_date,
+            'cast_count': self.cast_count,
+            'total_fee': self.total_fee
+        }
+
+
+# ---------------------------------------------------------------------------- #
+# Idempotency Keys Model 													   #
+# ---------------------------------------------------------------------------- #
+
+class IdempotencyKey(db.Model):
+    '''A stored response, keyed by the client (see ratelimit.client_id) and its Idempotency-Key.'''
+    __tablename__ = 'idempotency_keys'
+
+    subject = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    method = Column(String)
+    path = Column(String)
+    status_code = Column(Integer)
+    response = Column(Text)
+    location = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def matches(self, method, path):
+        return (self.method, self.path) == (method, path)
+
+
+# ---------------------------------------------------------------------------- #
+# Jobs Model 																   #
+# ---------------------------------------------------------------------------- #
+
+class Job(db.Model):
+    '''A queued background job, see jobs.py.'''
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    params = Column(Text, nullable=False, default='{}')
+    # queued, running, succeeded or failed
+    status = Column(String, nullable=False, default='queued', index=True)
+    progress = Column(Float, nullable=False, default=0)
+    message = Column(Text)
+    result = Column(Text)
+    error = Column(Text)
+    subject = Column(String)
+    worker = Column(String)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': json.loads(self.params),
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'attempts': self.attempts,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+class JobFile(db.Model):
+    '''
+    One part of a job's file: an import job's uploaded input or an export
+    job's output. Files live in the database, which the web and worker
+    processes share, split into parts of JOB_FILE_PART_BYTES so that neither
+    holds a whole file in memory. See jobs.py.
+    '''
+    __tablename__ = 'job_files'
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, db.ForeignKey('jobs.id'), nullable=False)
+    # input or output
+    role = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    part = Column(Integer, nullable=False)
+    content = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('uq_job_files_job_id_role_name_part', 'job_id', 'role', 'name', 'part', unique=True),
+    )
+
+
+
+# ---------------------------------------------------------------------------- #
+# Multi-get 																   #
+# ---------------------------------------------------------------------------- #
+
+ENTITY_CACHES = {
+    Actor: actor_cache,
+    Movie: movie_cache
+}
+
+
+def get_many_formatted(model, ids):
+    '''
+    Formatted records for many ids, as {id: record}; unknown ids are absent.
+    Cached records are used as-is, the rest are loaded with one
+    `WHERE id IN (...)` per MULTI_GET_CHUNK_SIZE ids and cached.
+    '''
+    cache = ENTITY_CACHES[model]
+    found = {}
+    missing = []
+
+    for entity_id in ids:
+        formatted = cache.get(entity_id)
+
+        if formatted is None:
+            missing.append(entity_id)
+        else:
+            found[entity_id] = formatted
+
+    for start in range(0, len(missing), MULTI_GET_CHUNK_SIZE):
+        chunk = missing[start:start + MULTI_GET_CHUNK_SIZE]
+
+        for obj in model.live().options(lazyload('*')).filter(model.id.in_(chunk)):
+            formatted = obj.format()
+            cache.set(obj.id, formatted)
+            found[obj.id] = formatted
+
+    return found
+
+
+# ---------------------------------------------------------------------------- #
+# Change Log Model 															   #
+# ---------------------------------------------------------------------------- #
+
+'''
+Change log
+    Append-only record of every actor/movie insert, update and delete and of
+    every Performance write, used by GET /changes so consumers can pull
+    deltas instead of re-reading whole tables.
+
+    Rows are written in the same transaction as the change itself: ORM writes
+    to Actor/Movie are captured by the after_flush listener below, the
+    set-based Performance helpers call record_changes() directly.
+
+    `seq` is assigned at INSERT, not at commit, so on Postgres a transaction
+    that started earlier can commit a lower seq after a consumer has already
+    paged past it. Each row therefore also stores the id of the transaction
+    that wrote it (`xid`), and changes_since() pages on (xid, seq) and only
+    returns rows whose transaction is older than the oldest one still in
+    progress: those rows are all committed, and anything committed later
+    sorts after them. On SQLite writers are serialized, so seq order is
+    commit order and `xid` stays empty.
+'''
+
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+    __table_args__ = (db.Index('ix_changes_xid_seq', 'xid', 'seq'),)
+
+    seq = Column(Integer, primary_key=True)
+    xid = Column(BigInteger)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer)
+    op = Column(String, nullable=False)
+    data = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def format(self):
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'op': self.op,
+            'data': json.loads(self.data) if self.data else None,
+            'created_at': self.created_at
         }
+
+
+def tracks_xid():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def insert_changes(session, rows):
+    statement = Change.__table__.insert()
+
+    if tracks_xid():
+        statement = statement.values(xid=func.txid_current())
+
+    session.execute(statement, rows)
+
+
+def changes_since(since, limit):
+    '''Up to `limit` committed changes after the change numbered `since`, in paging order.'''
+    if not tracks_xid():
+        return Change.query.filter(Change.seq > since).order_by(Change.seq).limit(limit).all()
+
+    since_xid = db.session.query(Change.xid).filter(Change.seq == since).scalar() if since else None
+    after = Change.seq > since if since_xid is None else or_(
+        Change.xid > since_xid,
+        and_(Change.xid == since_xid, Change.seq > since)
+    )
+
+    return (
+        Change.query
+        .filter(after, Change.xid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        .order_by(Change.xid, Change.seq)
+        .limit(limit)
+        .all()
+    )
+
+
+def change_row(entity, entity_id, op, data):
+    return {
+        'entity': entity,
+        'entity_id': entity_id,
+        'op': op,
+        'data': json.dumps(data, default=str),
+        'created_at': datetime.utcnow()
+    }
+
+
+def performance_change(op, row):
+    return change_row('performance', row['Movie_id'], op, {
+        'movie_id': row['Movie_id'],
+        'actor_id': row['Actor_id'],
+        'actor_fee': row.get('actor_fee')
+    })
+
+
+def record_changes(rows):
+    if rows:
+        insert_changes(db.session, rows)
+        invalidate_derived_caches(rows)
+
+
+def invalidate_derived_caches(rows):
+    '''Caches computed over whole tables, cleared when a change touches them.'''
+    if any(row['entity'] == 'movie' for row in rows):
+        invalidate_on_commit(release_calendar_cache)
+
+
+TRACKED_MODELS = {
+    Actor: 'actor',
+    Movie: 'movie'
+}
+
+
+@event.listens_for(db.session, 'after_flush')
+def record_flushed_changes(session, flush_context):
+    rows = []
+
+    for op, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            entity = TRACKED_MODELS.get(type(obj))
+
+            if entity is None:
+                continue
+            if op == 'update' and not session.is_modified(obj, include_collections=False):
+                continue
+
+            data = {'id': obj.id} if op == 'delete' else obj.format()
+            rows.append(change_row(entity, obj.id, op, data))
+
+    if rows:
+        insert_changes(session, rows)
+        invalidate_derived_caches(rows)
+
+
+# ---------------------------------------------------------------------------- #
+# Single-statement Writes 													   #
+# ---------------------------------------------------------------------------- #
+
+'''
+update_by_id / delete_by_id
+    PATCH and DELETE by primary key without loading the object first. An
+    update is one `UPDATE ... RETURNING` on Postgres (UPDATE, then SELECT by
+    id elsewhere); a delete sets the record's tombstone by id and takes its
+    castings out of the other side's counters. No ORM flush is involved, so
+    both write their change-log row and schedule the cache invalidation
+    themselves.
+'''
+
+
+def update_by_id(model, entity_id, values):
+    '''Returns the formatted, updated record, or None if it does not exist.'''
+    table = model.__table__
+
+    if not values:
+        return model.get_formatted(entity_id)
+
+    statement = table.update().where(and_(table.c.id == entity_id, table.c.deleted_at.is_(None))).values(**values)
+
+    if db.session.connection().dialect.name == 'postgresql':
+        row = db.session.execute(statement.returning(*table.c)).first()
+    elif db.session.execute(statement).rowcount:
+        row = db.session.execute(select([table]).where(table.c.id == entity_id)).first()
+    else:
+        row = None
+
+    if row is None:
+        return None
+
+    # format() only reads column attributes, which a result row has too.
+    formatted = model.format(row)
+    record_changes([change_row(TRACKED_MODELS[model], row.id, 'update', formatted)])
+    invalidate_on_commit(ENTITY_CACHES[model], row.id)
+    commit()
+
+    return formatted
+
+
+def delete_by_id(model, entity_id):
+    '''Tombstones the record (see Soft Delete); returns True if it existed.'''
+    table = model.__table__
+
+    deleted = db.session.execute(
+        table.update()
+        .where(and_(table.c.id == entity_id, table.c.deleted_at.is_(None)))
+        .values(deleted_at=datetime.utcnow())
+    ).rowcount
+
+    if deleted:
+        uncount_castings(model, entity_id)
+        record_changes([change_row(TRACKED_MODELS[model], entity_id, 'delete', {'id': entity_id})])
+        invalidate_on_commit(ENTITY_CACHES[model], entity_id)
+    commit()
+
+    return bool(deleted)
+
+
+# ---------------------------------------------------------------------------- #
+# Release Timeline 															   #
+# ---------------------------------------------------------------------------- #
+
+'''
+Release timeline
+    Range reads over movies.release_date, served from its index instead of
+    loading every movie:
+
+    movies_released(start, end, limit)
+        Movies released between start and end (inclusive, either may be
+        None), ordered by release date, at most `limit` of them.
+    release_calendar(granularity, start, end)
+        Number of releases per week (starting Monday), month or year. The
+        counts are aggregated per release date in SQL and folded into
+        buckets here, which works the same on every backend; the full
+        bucket list is cached per granularity and sliced per request.
+'''
+
+CALENDAR_GRANULARITIES = {
+    'week': lambda day: day - timedelta(days=day.weekday()),
+    'month': lambda day: day.replace(day=1),
+    'year': lambda day: day.replace(month=1, day=1)
+}
+
+
+def movies_released(start=None, end=None, limit=None):
+    query = Movie.live().options(lazyload('*')).filter(Movie.release_date.isnot(None))
+
+    if start is not None:
+        query = query.filter(Movie.release_date >= start)
+    if end is not None:
+        query = query.filter(Movie.release_date <= end)
+
+    return query.order_by(Movie.release_date, Movie.id).limit(limit).all()
+
+
+def release_calendar(granularity, start=None, end=None):
+    '''[(bucket start, number of releases)] in date order.'''
+    buckets = release_calendar_cache.get(granularity)
+
+    if buckets is None:
+        bucket_of = CALENDAR_GRANULARITIES[granularity]
+        counts = {}
+
+        rows = db.session.execute(
+            select([Movie.release_date, func.count()])
+            .where(and_(Movie.release_date.isnot(None), Movie.deleted_at.is_(None)))
+            .group_by(Movie.release_date)
+        )
+        for release_date, count in rows:
+            bucket = bucket_of(release_date)
+            counts[bucket] = counts.get(bucket, 0) + count
+
+        buckets = sorted(counts.items())
+        release_calendar_cache.set(granularity, buckets)
+
+    if start is not None:
+        start = CALENDAR_GRANULARITIES[granularity](start)
+
+    return [
+        (bucket, count) for bucket, count in buckets
+        if (start is None or bucket >= start) and (end is None or bucket <= end)
+    ]
+
+
+# ---------------------------------------------------------------------------- #
+# Denormalized Counters 													   #
+# ---------------------------------------------------------------------------- #
+
+'''
+Denormalized counters
+    movies.cast_count, movies.total_fee and actors.movie_count summarise
+    Performance so that list endpoints can show and sort by them without
+    aggregating. They are adjusted relatively (`SET n = n + delta`) in the
+    same transaction as every Performance write made through this module
+    and every delete: only castings whose actor and movie are both live are
+    counted, so deleting an actor or movie takes its castings out of the
+    other side's counters right away (uncount_castings), and purging it
+    later removes the rows without adjusting anything.
+
+    Performance rows written any other way (raw SQL, `manage.py import`)
+    leave the counters to reconcile_counters(), which recomputes them from
+    Performance and repairs the rows that drifted.
+'''
+
+
+def adjust_counters(movie_deltas, actor_deltas):
+    '''
+    movie_deltas maps movie id -> (cast_count delta, total_fee delta),
+    actor_deltas maps actor id -> movie_count delta.
+    '''
+    movies = Movie.__table__
+    actors = Actor.__table__
+
+    if movie_deltas:
+        db.session.execute(
+            movies.update()
+            .where(movies.c.id == bindparam('b_id'))
+            .values(cast_count=movies.c.cast_count + bindparam('b_cast_count'),
+                    total_fee=movies.c.total_fee + bindparam('b_total_fee')),
+            [{'b_id': movie_id, 'b_cast_count': cast_count, 'b_total_fee': total_fee}
+             for movie_id, (cast_count, total_fee) in movie_deltas.items()]
+        )
+        for movie_id in movie_deltas:
+            invalidate_on_commit(movie_cache, movie_id)
+
+    if actor_deltas:
+        db.session.execute(
+            actors.update()
+            .where(actors.c.id == bindparam('b_id'))
+            .values(movie_count=actors.c.movie_count + bindparam('b_movie_count')),
+            [{'b_id': actor_id, 'b_movie_count': movie_count}
+             for actor_id, movie_count in actor_deltas.items()]
+        )
+        for actor_id in actor_deltas:
+            invalidate_on_commit(actor_cache, actor_id)
+
+
+def uncount_castings(model, entity_id):
+    '''Takes a deleted actor's or movie's castings out of the counters of the live other side.'''
+    if model is Movie:
+        actors = Actor.__table__
+        actor_deltas = {}
+        for (actor_id,) in db.session.execute(
+                select([Performance.c.Actor_id])
+                .select_from(Performance.join(actors, actors.c.id == Performance.c.Actor_id))
+                .where(and_(Performance.c.Movie_id == entity_id, actors.c.deleted_at.is_(None)))):
+            actor_deltas[actor_id] = actor_deltas.get(actor_id, 0) - 1
+        adjust_counters({}, actor_deltas)
+    else:
+        movies = Movie.__table__
+        movie_deltas = {}
+        for movie_id, fee in db.session.execute(
+                select([Performance.c.Movie_id, Performance.c.actor_fee])
+                .select_from(Performance.join(movies, movies.c.id == Performance.c.Movie_id))
+                .where(and_(Performance.c.Actor_id == entity_id, movies.c.deleted_at.is_(None)))):
+            cast_count, total_fee = movie_deltas.get(movie_id, (0, 0))
+            movie_deltas[movie_id] = (cast_count - 1, total_fee - (fee or 0))
+        adjust_counters(movie_deltas, {})
+
+
+def reconcile_counters():
+    '''
+    Recomputes the counters from Performance, counting only castings of live
+    actors and movies, and rewrites the live rows whose stored values differ.
+    Deleted rows keep the counters they had when deleted and are left alone.
+    Returns the number of movies and actors repaired.
+    '''
+    movies = Movie.__table__
+    actors = Actor.__table__
+
+    movie_totals = {
+        movie_id: (cast_count, total_fee or 0)
+        for movie_id, cast_count, total_fee in db.session.execute(
+            select([Performance.c.Movie_id, func.count(), func.sum(Performance.c.actor_fee)])
+            .select_from(Performance.join(actors, actors.c.id == Performance.c.Actor_id))
+            .where(actors.c.deleted_at.is_(None))
+            .group_by(Performance.c.Movie_id)
+        )
+    }
+    actor_totals = dict(db.session.execute(
+        select([Performance.c.Actor_id, func.count()])
+        .select_from(Performance.join(movies, movies.c.id == Performance.c.Movie_id))
+        .where(movies.c.deleted_at.is_(None))
+        .group_by(Performance.c.Actor_id)
+    ).fetchall())
+
+    movie_rows = []
+    for movie_id, cast_count, total_fee in db.session.execute(
+            select([movies.c.id, movies.c.cast_count, movies.c.total_fee])
+            .where(movies.c.deleted_at.is_(None))):
+        expected = movie_totals.get(movie_id, (0, 0))
+        if cast_count != expected[0] or abs((total_fee or 0) - expected[1]) > 1e-6:
+            movie_rows.append({'b_id': movie_id, 'b_cast_count': expected[0], 'b_total_fee': expected[1]})
+
+    actor_rows = [
+        {'b_id': actor_id, 'b_movie_count': actor_totals.get(actor_id, 0)}
+        for actor_id, movie_count in db.session.execute(
+            select([actors.c.id, actors.c.movie_count]).where(actors.c.deleted_at.is_(None)))
+        if movie_count != actor_totals.get(actor_id, 0)
+    ]
+
+    if movie_rows:
+        db.session.execute(
+            movies.update().where(movies.c.id == bindparam('b_id'))
+            .values(cast_count=bindparam('b_cast_count'), total_fee=bindparam('b_total_fee')),
+            movie_rows
+        )
+        invalidate_on_commit(movie_cache)
+    if actor_rows:
+        db.session.execute(
+            actors.update().where(actors.c.id == bindparam('b_id'))
+            .values(movie_count=bindparam('b_movie_count')),
+            actor_rows
+        )
+        invalidate_on_commit(actor_cache)
+    commit()
+
+    return len(movie_rows), len(actor_rows)
+
+
+# ---------------------------------------------------------------------------- #
+# Soft Delete 																   #
+# ---------------------------------------------------------------------------- #
+
+'''
+Soft delete
+    DELETE /actors/<id> and DELETE /movies/<id> only set `deleted_at`, a
+    single-row UPDATE whatever the size of the cast. Tombstoned rows are
+    excluded by Model.live(), which every read of actors and movies goes
+    through, and can no longer be edited or cast. Their castings stop
+    counting in the other side's counters when the tombstone is set.
+
+    purge_deleted() (`python manage.py purge`) removes tombstoned rows and
+    their Performance links for good, PURGE_BATCH_SIZE rows per transaction
+    so that no transaction holds its locks for long. The counters were
+    adjusted at delete time, so purging leaves them alone. The change log got its `delete` entry
+    when the row was tombstoned; purging does not add entries.
+'''
+
+
+def purge_batch(model, older_than, batch_size):
+    '''Purges up to batch_size rows tombstoned before older_than; returns how many.'''
+    table = model.__table__
+
+    ids = [row[0] for row in db.session.execute(
+        select([table.c.id])
+        .where(and_(table.c.deleted_at.isnot(None), table.c.deleted_at <= older_than))
+        .order_by(table.c.id)
+        .limit(batch_size)
+    )]
+
+    if ids:
+        own_column = Performance.c.Movie_id if model is Movie else Performance.c.Actor_id
+        db.session.execute(Performance.delete().where(own_column.in_(ids)))
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+    db.session.commit()
+
+    return len(ids)
+
+
+def purge_deleted(older_than=None, batch_size=PURGE_BATCH_SIZE, report=print):
+    older_than = older_than or datetime.utcnow()
+    results = {}
+
+    for name, model in (('movies', Movie), ('actors', Actor)):
+        purged = 0
+
+        while True:
+            batch = purge_batch(model, older_than, batch_size)
+            purged += batch
+
+            if batch < batch_size:
+                break
+
+        report('{:<13} {:>10} purged'.format(name, purged))
+        results[name] = purged
+
+    return results
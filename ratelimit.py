@@ -0,0 +1,294 @@
+import math
+import threading
+import time
+import uuid
+from functools import wraps
+from flask import abort
+from stores import (
+    SQLiteFileStore,
+    load_store
+)
+from config import (
+    RATE_LIMITS,
+    RATE_LIMIT_BACKEND,
+    MAX_INFLIGHT_REQUESTS,
+    INFLIGHT_BACKEND,
+    INFLIGHT_STALE_SECONDS
+)
+
+# ---------------------------------------------------------------------------- #
+# Token Buckets                                                                #
+# ---------------------------------------------------------------------------- #
+
+'''
+Per-client rate limiting
+    Every client (the JWT `sub`, see client_id) has one token bucket per
+    budget. A bucket holds up to `burst` tokens and refills at `rate` tokens
+    per second; each request takes one. An empty bucket rejects the request
+    with 429 and a Retry-After of the time until the next token.
+
+    Budgets are configured in config.RATE_LIMITS so that expensive routes
+    (list scans, exports, bulk/batch writes) can be throttled harder than
+    single-record reads.
+
+Backends (RATE_LIMIT_BACKEND)
+    memory              per-process buckets; each gunicorn worker enforces
+                        the budget on its own.
+    sqlite:<path>       buckets in a local SQLite file shared by every worker
+                        on the host.
+    <module>:<Class>    any object with take(key, rate, burst, cost).
+
+    See stores.py for how the spec is read.
+'''
+
+
+def refill_and_take(tokens, updated, now, rate, burst, cost):
+    '''Returns (tokens left, seconds to wait); the wait is 0 when allowed.'''
+    tokens = burst if tokens is None else min(burst, tokens + (now - updated) * rate)
+
+    if tokens >= cost:
+        return tokens - cost, 0
+
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBackend(object):
+    # Full buckets are dropped every this many takes.
+    SWEEP_EVERY = 1000
+
+    def __init__(self):
+        # key -> (tokens, updated, time the bucket is full again)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (None, now, now))
+            tokens, retry_after = refill_and_take(tokens, updated, now, rate, burst, cost)
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+
+            self._takes += 1
+            if self._takes % self.SWEEP_EVERY == 0:
+                self._sweep(now)
+
+        return retry_after
+
+    def _sweep(self, now):
+        # A bucket that has refilled to burst is the same as no bucket, so
+        # clients that went idle stop taking memory.
+        for key in [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[key]
+
+
+class SQLiteBackend(SQLiteFileStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS buckets '
+        '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)',
+    )
+
+    def take(self, key, rate, burst, cost=1):
+        connection = self._connection()
+        now = time.time()
+
+        # BEGIN IMMEDIATE takes the write lock up front, so the read-modify-
+        # write below is atomic across worker processes.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (None, now)
+            tokens, retry_after = refill_and_take(tokens, updated, now, rate, burst, cost)
+            connection.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return retry_after
+
+
+def load_backend(spec):
+    return load_store(spec, MemoryBackend, SQLiteBackend)
+
+
+class RateLimiter(object):
+    def __init__(self, backend, budgets):
+        self.backend = backend
+        self.budgets = budgets
+        self.allowed = 0
+        self.limited = 0
+
+    def check(self, budget, client):
+        rate, burst = self.budgets.get(budget, self.budgets['default'])
+
+        if rate <= 0:
+            return 0
+
+        retry_after = self.backend.take('{}:{}'.format(budget, client), rate, burst)
+
+        if retry_after:
+            self.limited += 1
+        else:
+            self.allowed += 1
+
+        return retry_after
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited
+        }
+
+
+limiter = RateLimiter(load_backend(RATE_LIMIT_BACKEND), RATE_LIMITS)
+
+
+def client_id(payload):
+    return payload.get('sub') or payload.get('azp') or 'anonymous'
+
+
+def check_rate_limit(budget, payload):
+    retry_after = limiter.check(budget, client_id(payload))
+
+    if retry_after:
+        abort(429, {
+            'message': 'rate limit exceeded for {}.'.format(budget),
+            'retry_after': int(math.ceil(retry_after))
+        })
+
+
+'''
+@rate_limit(budget) decorator
+    Charges one token of `budget` to the caller. Apply below @requires_auth,
+    as it receives the decoded payload.
+'''
+
+
+def rate_limit(budget='default'):
+    def rate_limit_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            check_rate_limit(budget, payload)
+            return f(payload, *args, **kwargs)
+
+        return wrapper
+
+    return rate_limit_decorator
+
+
+# ---------------------------------------------------------------------------- #
+# Admission Control                                                            #
+# ---------------------------------------------------------------------------- #
+
+'''
+InflightLimiter
+    Caps the number of requests handled at once. Requests over the cap are
+    shed immediately with 503 and Retry-After instead of queueing behind
+    slow ones. A cap of 0 disables it.
+
+    acquire() returns a slot (None when shed) that release() gives back.
+
+Slot backends (INFLIGHT_BACKEND)
+    memory              a counter per worker process: the cap applies to
+                        each worker and only matters with threaded workers.
+    sqlite:<path>       one row per request in a SQLite file shared by every
+                        worker on the host, so the cap applies to the host
+                        whatever the worker model. Slots older than
+                        INFLIGHT_STALE_SECONDS, left by a killed worker, are
+                        reclaimed.
+    <module>:<Class>    any object with acquire(limit), release(slot) and
+                        count().
+'''
+
+
+class MemorySlots(object):
+    def __init__(self):
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, limit):
+        with self._lock:
+            if limit and self.inflight >= limit:
+                return None
+
+            self.inflight += 1
+            return True
+
+    def release(self, slot):
+        with self._lock:
+            self.inflight -= 1
+
+    def count(self):
+        return self.inflight
+
+
+class SQLiteSlots(SQLiteFileStore):
+    schema = ('CREATE TABLE IF NOT EXISTS inflight (slot TEXT PRIMARY KEY, started REAL NOT NULL)',)
+
+    def __init__(self, path, stale_seconds=INFLIGHT_STALE_SECONDS):
+        super(SQLiteSlots, self).__init__(path)
+        self.stale_seconds = stale_seconds
+
+    def acquire(self, limit):
+        connection = self._connection()
+        now = time.time()
+        slot = uuid.uuid4().hex
+
+        # Count and insert under the write lock, like SQLiteBackend.take.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM inflight WHERE started < ?', (now - self.stale_seconds,))
+            count = connection.execute('SELECT count(*) FROM inflight').fetchone()[0]
+
+            if limit and count >= limit:
+                slot = None
+            else:
+                connection.execute('INSERT INTO inflight VALUES (?, ?)', (slot, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return slot
+
+    def release(self, slot):
+        self._connection().execute('DELETE FROM inflight WHERE slot = ?', (slot,))
+
+    def count(self):
+        return self._connection().execute('SELECT count(*) FROM inflight').fetchone()[0]
+
+
+def load_slots(spec):
+    return load_store(spec, MemorySlots, SQLiteSlots)
+
+
+class InflightLimiter(object):
+    def __init__(self, limit, slots):
+        self.limit = limit
+        self.slots = slots
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        slot = self.slots.acquire(self.limit)
+
+        if slot is None:
+            with self._lock:
+                self.shed += 1
+
+        return slot
+
+    def release(self, slot):
+        self.slots.release(slot)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'inflight': self.slots.count(),
+            'shed': self.shed
+        }
+
+
+inflight = InflightLimiter(MAX_INFLIGHT_REQUESTS, load_slots(INFLIGHT_BACKEND))
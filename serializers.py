@@ -0,0 +1,70 @@
+from datetime import date
+from flask import (
+    Response,
+    request,
+    jsonify
+)
+
+try:
+    import msgpack
+except ImportError:  # optional: `pip install msgpack` to enable
+    msgpack = None
+
+# ---------------------------------------------------------------------------- #
+# Response Formats                                                             #
+# ---------------------------------------------------------------------------- #
+
+'''
+List responses are negotiated via the Accept header:
+
+    application/json                  (default) a list of objects per record
+    application/vnd.columnar+json     one array per field:
+                                      {"actors": {"id": [...], "name": [...]}}
+    application/msgpack               the default layout as MessagePack, dates
+                                      as ISO 8601 strings; only offered when
+                                      the msgpack package is installed
+
+Errors are always plain JSON.
+'''
+
+JSON_MIMETYPE = 'application/json'
+COLUMNAR_MIMETYPE = 'application/vnd.columnar+json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+def available_mimetypes():
+    # JSON comes first so that "Accept: */*" keeps today's behaviour.
+    mimetypes = [JSON_MIMETYPE, COLUMNAR_MIMETYPE]
+
+    if msgpack is not None:
+        mimetypes += [MSGPACK_MIMETYPE, 'application/x-msgpack']
+
+    return mimetypes
+
+
+def to_columns(records):
+    fields = list(records[0]) if records else []
+    return {field: [record[field] for record in records] for field in fields}
+
+
+def _msgpack_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError('cannot serialize {!r}'.format(value))
+
+
+def render_list(key, records, **extra):
+    mimetype = request.accept_mimetypes.best_match(available_mimetypes(), default=JSON_MIMETYPE)
+
+    if mimetype == COLUMNAR_MIMETYPE:
+        response = jsonify(dict(extra, success=True, **{key: to_columns(records)}))
+        response.mimetype = COLUMNAR_MIMETYPE
+    elif mimetype in (MSGPACK_MIMETYPE, 'application/x-msgpack'):
+        body = msgpack.packb(dict(extra, success=True, **{key: records}),
+                             default=_msgpack_default, use_bin_type=True)
+        response = Response(body, mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(dict(extra, success=True, **{key: records}))
+
+    response.vary.add('Accept')
+    return response
@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from stores import (
+    SQLiteFileStore,
+    load_store as load_any_store
+)
+
+# ---------------------------------------------------------------------------- #
+# Shared Cache                                                                 #
+# ---------------------------------------------------------------------------- #
+
+'''
+SharedCache
+    A cache of JSON-serialisable values that every worker on a host can
+    share, so that data which is expensive to produce (signing keys fetched
+    from the identity provider, verified token payloads) is produced once per
+    host instead of once per gunicorn worker. Entries expire after a
+    per-entry ttl (seconds).
+
+    get_or_refresh(key, produce, ttl) is single-flight: on a miss, one caller
+    takes the key's refresh lock and runs produce(); every other caller, in
+    any worker, waits up to `lock_seconds` for that result instead of
+    producing it again. A lock left by a crashed worker expires after
+    `lock_seconds`.
+
+Stores (AUTH_CACHE_BACKEND)
+    memory              per-process; the workers do not share it.
+    sqlite:<path>       a local SQLite file shared by every worker on the
+                        host.
+    <module>:<Class>    any object with get(key), set(key, value, ttl),
+                        acquire(key, ttl) and release(key).
+
+    See stores.py for how the spec is read.
+'''
+
+
+class MemoryStore(object):
+    def __init__(self, maxsize=10000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] <= self.clock():
+                return None
+
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def acquire(self, key, ttl):
+        now = self.clock()
+
+        with self._lock:
+            if self._locks.get(key, 0) > now:
+                return False
+
+            self._locks[key] = now + ttl
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._locks.pop(key, None)
+
+
+class SQLiteStore(SQLiteFileStore):
+    schema = (
+        'CREATE TABLE IF NOT EXISTS entries '
+        '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS locks (key TEXT PRIMARY KEY, expires REAL NOT NULL)'
+    )
+    # Expired rows are deleted every this many writes.
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        super(SQLiteStore, self).__init__(path)
+        self._writes = 0
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM entries WHERE key = ? AND expires > ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        connection = self._connection()
+        now = time.time()
+
+        connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, json.dumps(value), now + ttl))
+
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            connection.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+
+    def acquire(self, key, ttl):
+        connection = self._connection()
+        now = time.time()
+
+        # Each statement is atomic on its own: of several workers racing for
+        # an expired lock, only one INSERT succeeds.
+        connection.execute('DELETE FROM locks WHERE key = ? AND expires <= ?', (key, now))
+        return connection.execute('INSERT OR IGNORE INTO locks VALUES (?, ?)', (key, now + ttl)).rowcount == 1
+
+    def release(self, key):
+        self._connection().execute('DELETE FROM locks WHERE key = ?', (key,))
+
+
+def load_store(spec):
+    return load_any_store(spec, MemoryStore, SQLiteStore)
+
+
+class SharedCache(object):
+    def __init__(self, store, lock_seconds=10.0, poll_seconds=0.05):
+        self.store = store
+        self.lock_seconds = lock_seconds
+        self.poll_seconds = poll_seconds
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.waits = 0
+
+    def get(self, key):
+        value = self.store.get(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value, ttl):
+        if ttl > 0:
+            self.store.set(key, value, ttl)
+
+    def get_or_refresh(self, key, produce, ttl):
+        value = self.get(key)
+
+        if value is None:
+            value = self.refresh(key, produce, ttl)
+
+        return value
+
+    def refresh(self, key, produce, ttl, stale=None):
+        '''
+        Replaces `stale` (the value the caller already has, if any) with a
+        freshly produced one, producing it at most once across workers.
+        '''
+        lock_key = 'lock:' + key
+
+        if self.store.acquire(lock_key, self.lock_seconds):
+            try:
+                value = produce()
+                self.set(key, value, ttl)
+                self.refreshes += 1
+                return value
+            finally:
+                self.store.release(lock_key)
+
+        self.waits += 1
+        deadline = time.monotonic() + self.lock_seconds
+
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_seconds)
+            value = self.store.get(key)
+
+            if value is not None and value != stale:
+                return value
+
+        # The refreshing worker failed or is stuck; do not wait any longer.
+        return produce()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.store).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'waits': self.waits,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None
+        }
@@ -0,0 +1,133 @@
+import threading
+from functools import wraps
+from flask import (
+    Response,
+    make_response,
+    request
+)
+from config import REQUEST_COALESCING
+
+# ---------------------------------------------------------------------------- #
+# Request Coalescing                                                           #
+# ---------------------------------------------------------------------------- #
+
+'''
+SingleFlight
+    Collapses concurrent calls for the same key into one: the first caller
+    (the leader) runs produce(), callers arriving while it runs wait for it
+    and get its result, or its exception, instead of running produce()
+    themselves. Once the leader has finished the key is free again, so
+    nothing is cached beyond the call itself.
+
+    Per process, like the caches: it only coalesces requests served by the
+    same worker at the same time, so it needs threaded (gthread) or gevent
+    workers.
+
+@coalesce decorator
+    Applied to GET list reads below @requires_auth and @rate_limit, so that
+    every caller is still authorised and charged. Identical requests (same
+    endpoint, path, query string and Accept header) in flight at once share
+    one database execution and one serialized body. The response does not
+    depend on the caller, only on their permission, which was checked.
+
+    A request that has written something calls forget() after committing,
+    so reads arriving afterwards never join a flight started before the
+    write and always see it.
+'''
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, produce):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = produce()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+        return flight.value
+
+    def forget(self):
+        '''Callers arriving from now on start new flights instead of joining running ones.'''
+        with self._lock:
+            self._flights.clear()
+
+    def stats(self):
+        with self._lock:
+            calls = self.leaders + self.coalesced
+            return {
+                'enabled': REQUEST_COALESCING,
+                'inflight': len(self._flights),
+                'executed': self.leaders,
+                'coalesced': self.coalesced,
+                'coalesced_rate': round(self.coalesced / calls, 4) if calls else None
+            }
+
+
+read_flights = SingleFlight()
+
+
+def request_key():
+    return (
+        request.endpoint,
+        request.path,
+        tuple(sorted(request.args.items(multi=True))),
+        request.headers.get('Accept')
+    )
+
+
+def coalesce(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        if not REQUEST_COALESCING:
+            return f(payload, *args, **kwargs)
+
+        leader_response = []
+
+        def produce():
+            response = make_response(f(payload, *args, **kwargs))
+            leader_response.append(response)
+            return response.get_data(), response.status_code, list(response.headers.items())
+
+        body, status, headers = read_flights.do(request_key(), produce)
+
+        if leader_response:
+            return leader_response[0]
+
+        return Response(body, status=status, headers=headers)
+
+    return wrapper
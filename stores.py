@@ -0,0 +1,56 @@
+import importlib
+import sqlite3
+import threading
+
+# ---------------------------------------------------------------------------- #
+# Shared Stores                                                                #
+# ---------------------------------------------------------------------------- #
+
+'''
+State the gunicorn workers of a host can share: the rate limiter's buckets
+and in-flight slots (ratelimit.py) and the auth cache (sharedcache.py). Each
+is configured by a spec string, read by load_store:
+
+    memory              per-process; the workers do not share it.
+    sqlite:<path>       a local SQLite file shared by every worker on the
+                        host; a stand-in for a networked store.
+    <module>:<Class>    any class implementing the store's methods, e.g. a
+                        Redis-backed one, built without arguments.
+
+SQLiteFileStore
+    Base of the sqlite stores: one autocommit connection per thread to the
+    file, in WAL mode, creating the tables in `schema` on first use.
+'''
+
+
+class SQLiteFileStore(object):
+    # CREATE TABLE IF NOT EXISTS statements run on every new connection.
+    schema = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                connection.execute(statement)
+            self._local.connection = connection
+
+        return connection
+
+
+def load_store(spec, memory, sqlite):
+    '''Builds the store `spec` names: memory(), sqlite(path) or the named class.'''
+    if spec == 'memory':
+        return memory()
+
+    if spec.startswith('sqlite:'):
+        return sqlite(spec[len('sqlite:'):])
+
+    module_name, _, class_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
@@ -1,9 +1,31 @@
+import gzip
+import hashlib
+import io
 import json
-from datetime import date
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
 import unittest
-from flask_sqlalchemy import SQLAlchemy
+import rsa
+from jose import jwk, jwt
+from sqlalchemy import event
+import auth
+import ratelimit
+import sharedcache
+import timeouts
+from singleflight import read_flights
+from flask import jsonify
 from app import create_app
-from models import setup_db, db_drop_and_create_all
+from models import (
+    setup_db, create_all, db_drop_and_create_all, db, reconcile_counters, Actor, Movie, Job, JobFile
+)
+from bulk_import import bulk_import
+from export import EXPORT_TABLES, column_names
+from jobs import JobProgress, run_worker, expire_jobs
 from config import (
     bearer_tokens,
     DATABASE_URL
@@ -22,6 +44,62 @@ executive_producer_auth_header = {
 }
 
 
+# ---------------------------------------------------------------------------- #
+# Local Token Signer 														   #
+# ---------------------------------------------------------------------------- #
+
+'''
+LocalSigner
+    Signs tokens with an RSA key generated for the test run, for permissions
+    none of the Auth0 test roles have (e.g. read:metrics) and for the auth
+    tests. AgencyTestCase registers its issuer in auth.issuers; each token
+    gets its own subject so it has its own rate limit buckets.
+'''
+
+
+class LocalSigner(object):
+    def __init__(self, issuer='https://capstone.test/', audience='capstone-test', kid='test'):
+        public_key, private_key = rsa.newkeys(1024)
+
+        self.issuer = issuer
+        self.audience = audience
+        self.kid = kid
+        self.private_key = private_key.save_pkcs1().decode()
+        self.jwk = {
+            name: value.decode() if isinstance(value, bytes) else value
+            for name, value in jwk.construct(public_key.save_pkcs1().decode(), 'RS256').to_dict().items()
+        }
+        self.jwk.update(kid=kid, use='sig')
+
+    def jwks(self):
+        return {'keys': [self.jwk]}
+
+    def token(self, permissions, **claims):
+        payload = {
+            'iss': self.issuer,
+            'aud': self.audience,
+            'sub': 'local|' + uuid.uuid4().hex,
+            'exp': int(time.time()) + 600,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+
+        return jwt.encode(payload, self.private_key, algorithm='RS256', headers={'kid': self.kid})
+
+    def header(self, permissions, **claims):
+        return {'Authorization': 'Bearer ' + self.token(permissions, **claims)}
+
+    def register(self):
+        auth.issuers[self.issuer] = auth.Issuer(
+            self.issuer, self.audience, auth.StaticKeySet(self.jwks()), ['RS256'])
+
+    def unregister(self):
+        auth.issuers.pop(self.issuer, None)
+
+
+local_signer = LocalSigner()
+
+
 # ---------------------------------------------------------------------------- #
 # Setup of Unittest 														   #
 # ---------------------------------------------------------------------------- #
@@ -37,12 +115,16 @@ class AgencyTestCase(unittest.TestCase):
         setup_db(self.app, self.database_path)
 
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
+            create_all()
+
+        local_signer.register()
 
     def tearDown(self):
-        pass
+        local_signer.unregister()
+
+    def metrics(self):
+        res = self.client().get('/metrics', headers=local_signer.header(['read:metrics']))
+        return json.loads(res.data)
 
     # ----------------------------------------------------------------------------#
     # Tests for /actors POST
@@ -86,6 +168,41 @@ class AgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_retried_create_actor_with_idempotency_key(self):
+        json_create_actor = {
+            'name': 'John',
+            'age': 23
+        }
+        headers = dict(casting_director_auth_header, **{'Idempotency-Key': str(uuid.uuid4())})
+
+        first = self.client().post('/actors', json=json_create_actor, headers=headers)
+        retry = self.client().post('/actors', json=json_create_actor, headers=headers)
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(json.loads(retry.data)['created'], json.loads(first.data)['created'])
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+
+    def test_idempotency_keys_are_per_client(self):
+        key = {'Idempotency-Key': str(uuid.uuid4())}
+        first = self.client().post('/actors', json={'name': 'John', 'age': 23},
+                                   headers=dict(local_signer.header(['create:actors']), **key))
+        second = self.client().post('/actors', json={'name': 'Jane', 'age': 31},
+                                    headers=dict(local_signer.header(['create:actors']), **key))
+
+        self.assertEqual(second.status_code, 200)
+        self.assertIsNone(second.headers.get('Idempotent-Replayed'))
+        self.assertNotEqual(json.loads(second.data)['created'], json.loads(first.data)['created'])
+
+    def test_error_422_reused_idempotency_key(self):
+        headers = dict(executive_producer_auth_header, **{'Idempotency-Key': str(uuid.uuid4())})
+
+        self.client().post('/actors', json={'name': 'John', 'age': 23}, headers=headers)
+        res = self.client().post('/movies', json={'title': 'Movie', 'release_date': date.today()}, headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
     # ----------------------------------------------------------------------------#
     # Tests for /actors GET
     # ----------------------------------------------------------------------------#
@@ -98,6 +215,27 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertTrue(len(data['actors']) > 0)
 
+    def test_get_all_actors_columnar(self):
+        headers = dict(casting_assistant_auth_header, Accept='application/vnd.columnar+json')
+        res = self.client().get('/actors?page=1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/vnd.columnar+json')
+        self.assertEqual(len(data['actors']['id']), len(data['actors']['name']))
+
+    def test_get_all_actors_sorted_by_movie_count(self):
+        res = self.client().get('/actors?page=1&sort=-movie_count', headers=casting_assistant_auth_header)
+        counts = [actor['movie_count'] for actor in json.loads(res.data)['actors']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_error_400_get_actors_unknown_sort(self):
+        res = self.client().get('/actors?page=1&sort=salary', headers=casting_assistant_auth_header)
+
+        self.assertEqual(res.status_code, 400)
+
     def test_error_401_get_all_actors(self):
         res = self.client().get('/actors?page=1')
         data = json.loads(res.data)
@@ -114,6 +252,148 @@ class AgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_get_actor(self):
+        created = self.client().post('/actors', json={'name': 'John', 'age': 23},
+                                     headers=casting_director_auth_header)
+        actor_id = json.loads(created.data)['created']
+
+        res = self.client().get('/actors/{}'.format(actor_id), headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['actor']['name'], 'John')
+
+    def test_error_404_get_actor(self):
+        res = self.client().get('/actors/1234567890', headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_get_actor_after_edit_is_not_stale(self):
+        created = self.client().post('/actors', json={'name': 'John', 'age': 23},
+                                     headers=casting_director_auth_header)
+        actor_id = json.loads(created.data)['created']
+
+        self.client().get('/actors/{}'.format(actor_id), headers=casting_assistant_auth_header)
+        self.client().patch('/actors/{}'.format(actor_id), json={'age': 33}, headers=casting_director_auth_header)
+        res = self.client().get('/actors/{}'.format(actor_id), headers=casting_assistant_auth_header)
+
+        self.assertEqual(json.loads(res.data)['actor']['age'], 33)
+
+    def test_get_actors_by_ids(self):
+        created = self.client().post('/actors', json={'name': 'John', 'age': 23},
+                                     headers=casting_director_auth_header)
+        actor_id = json.loads(created.data)['created']
+
+        res = self.client().get('/actors?ids={},1234567890'.format(actor_id), headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [actor_id])
+        self.assertEqual(data['missing'], [1234567890])
+
+    def test_lookup_movies(self):
+        res = self.client().post('/movies/lookup', json={'ids': [1234567890]}, headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [])
+        self.assertEqual(data['missing'], [1234567890])
+
+    def test_get_releases_in_range(self):
+        res = self.client().get('/movies/releases?from=2000-01-01&to=2000-12-31',
+                                headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn('movies', data)
+
+    def test_error_400_releases_limit_below_one(self):
+        for limit in (0, -1):
+            res = self.client().get('/movies/releases?limit={}'.format(limit),
+                                    headers=local_signer.header(['read:movies']))
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_release_calendar_counts_new_movie(self):
+        self.client().get('/movies/calendar?granularity=year', headers=casting_assistant_auth_header)
+        self.client().post('/movies', json={'title': 'Timeline', 'release_date': '2099-06-15'},
+                           headers=executive_producer_auth_header)
+        res = self.client().get('/movies/calendar?granularity=year&from=2099-01-01',
+                                headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['buckets'][0]['start'], '2099-01-01')
+        self.assertTrue(data['buckets'][0]['count'] >= 1)
+
+    def test_error_400_release_calendar(self):
+        res = self.client().get('/movies/calendar?granularity=day', headers=casting_assistant_auth_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_metrics(self):
+        res = self.client().get('/metrics', headers=local_signer.header(['read:metrics']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('hit_rate', data['caches']['actors'])
+        self.assertIn('limited', data['rate_limits'])
+        self.assertIn('shed', data['inflight'])
+        self.assertIn('coalesced', data['coalesced_reads'])
+
+    def test_error_401_metrics(self):
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_error_403_metrics(self):
+        res = self.client().get('/metrics', headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(data['message'], 'Permission not found.')
+
+    def test_concurrent_identical_reads_are_counted(self):
+        headers = local_signer.header(['read:movies'])
+        before = self.metrics()['coalesced_reads']
+        statuses = []
+        release = threading.Event()
+
+        def hold_leader(*args):
+            # The leader's queries wait until the other readers have joined its flight.
+            release.wait(5)
+
+        def read():
+            statuses.append(self.client().get('/movies?page=1', headers=headers).status_code)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', hold_leader)
+        threads = [threading.Thread(target=read) for _ in range(5)]
+
+        try:
+            for thread in threads:
+                thread.start()
+
+            deadline = time.monotonic() + 5
+            while read_flights.stats()['coalesced'] - before['coalesced'] < 4 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+            event.remove(engine, 'before_cursor_execute', hold_leader)
+
+        after = self.metrics()['coalesced_reads']
+
+        self.assertEqual(len(set(statuses)), 1)
+        self.assertEqual(after['executed'] - before['executed'], 1)
+        self.assertEqual(after['coalesced'] - before['coalesced'], 4)
+
     # ----------------------------------------------------------------------------#
     # Tests for /actors PATCH
     # ----------------------------------------------------------------------------#
@@ -150,6 +430,13 @@ class AgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_error_422_edit_actor_invalid_age(self):
+        res = self.client().patch('/actors/1234567890', json={'age': 'old'}, headers=casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
     # ----------------------------------------------------------------------------#
     # Tests for /actors DELETE
     # ----------------------------------------------------------------------------#
@@ -178,6 +465,19 @@ class AgencyTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(data['deleted'], '2')
 
+    def test_deleted_actor_is_hidden(self):
+        created = self.client().post('/actors', json={'name': 'John', 'age': 23},
+                                     headers=casting_director_auth_header)
+        actor_id = json.loads(created.data)['created']
+
+        self.client().delete('/actors/{}'.format(actor_id), headers=casting_director_auth_header)
+        res = self.client().get('/actors/{}'.format(actor_id), headers=casting_assistant_auth_header)
+        lookup = json.loads(self.client().get('/actors?ids={}'.format(actor_id),
+                                              headers=casting_assistant_auth_header).data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(lookup['missing'], [actor_id])
+
     def test_error_404_delete_actor(self):
         res = self.client().delete('/actors/1234567890', headers=casting_director_auth_header)
         data = json.loads(res.data)
@@ -277,6 +577,15 @@ class AgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'resource not found')
 
+    def test_error_422_edit_movie_invalid_release_date(self):
+        for release_date in ('next summer', '2020-02-30', 20200101):
+            res = self.client().patch('/movies/1234567890', json={'release_date': release_date},
+                                      headers=executive_producer_auth_header)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertFalse(data['success'])
+
     # ----------------------------------------------------------------------------#
     # Tests for /movies DELETE
     # ----------------------------------------------------------------------------#
@@ -313,6 +622,858 @@ class AgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], 'resource not found')
 
+    # ----------------------------------------------------------------------------#
+    # Tests for /movies/<movie_id>/actors
+    # ----------------------------------------------------------------------------#
+
+    def create_actor_and_movie(self):
+        actor = self.client().post('/actors', json={'name': 'Cast', 'age': 30},
+                                   headers=executive_producer_auth_header)
+        movie = self.client().post('/movies', json={'title': 'Casting', 'release_date': date.today()},
+                                   headers=executive_producer_auth_header)
+
+        return json.loads(actor.data)['created'], json.loads(movie.data)['created']
+
+    def test_cast_and_uncast_actor(self):
+        actor_id, movie_id = self.create_actor_and_movie()
+
+        res = self.client().post('/movies/{}/actors'.format(movie_id),
+                                 json={'actors': [{'id': actor_id, 'actor_fee': 500.0}]},
+                                 headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['cast'], [actor_id])
+
+        res = self.client().delete('/movies/{}/actors/{}'.format(movie_id, actor_id),
+                                   headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['removed'], 1)
+
+    def test_cast_updates_counters(self):
+        actor_id, movie_id = self.create_actor_and_movie()
+
+        self.client().post('/movies/{}/actors'.format(movie_id),
+                           json={'actors': [{'id': actor_id, 'actor_fee': 500.0}]},
+                           headers=executive_producer_auth_header)
+        movie = json.loads(self.client().get('/movies/{}'.format(movie_id),
+                                             headers=casting_assistant_auth_header).data)['movie']
+        actor = json.loads(self.client().get('/actors/{}'.format(actor_id),
+                                             headers=casting_assistant_auth_header).data)['actor']
+
+        self.assertEqual(movie['cast_count'], 1)
+        self.assertEqual(movie['total_fee'], 500.0)
+        self.assertEqual(actor['movie_count'], 1)
+
+    def test_delete_actor_takes_it_out_of_counters(self):
+        actor_id, movie_id = self.create_actor_and_movie()
+
+        self.client().post('/movies/{}/actors'.format(movie_id),
+                           json={'actors': [{'id': actor_id, 'actor_fee': 500.0}]},
+                           headers=executive_producer_auth_header)
+        self.client().delete('/actors/{}'.format(actor_id), headers=executive_producer_auth_header)
+        movie = json.loads(self.client().get('/movies/{}'.format(movie_id),
+                                             headers=casting_assistant_auth_header).data)['movie']
+
+        self.assertEqual(movie['cast_count'], 0)
+        self.assertEqual(movie['total_fee'], 0)
+
+    def test_error_404_cast_unknown_actor(self):
+        actor_id, movie_id = self.create_actor_and_movie()
+
+        res = self.client().post('/movies/{}/actors'.format(movie_id),
+                                 json={'actors': [1234567890]},
+                                 headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_error_403_cast_actor(self):
+        res = self.client().post('/movies/1/actors', json={'actors': [1]}, headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Permission not found.')
+
+    # ----------------------------------------------------------------------------#
+    # Tests for /changes GET
+    # ----------------------------------------------------------------------------#
+
+    def test_get_changes_after_create(self):
+        res = self.client().get('/changes?since=0&limit=1', headers=casting_assistant_auth_header)
+        since = json.loads(res.data)['next']
+
+        created = self.client().post('/actors', json={'name': 'John', 'age': 23},
+                                     headers=casting_director_auth_header)
+        actor_id = json.loads(created.data)['created']
+
+        res = self.client().get('/changes?since={}'.format(since), headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn(('actor', actor_id, 'insert'),
+                      [(change['entity'], change['entity_id'], change['op']) for change in data['changes']])
+
+    def test_error_400_changes_limit_below_one(self):
+        res = self.client().get('/changes?limit=-1', headers=local_signer.header(['read:actors', 'read:movies']))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_error_401_get_changes(self):
+        res = self.client().get('/changes')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Authorization header is expected.')
+
+    # ----------------------------------------------------------------------------#
+    # Tests for /batch POST
+    # ----------------------------------------------------------------------------#
+
+    def test_batch_requests(self):
+        json_batch = {
+            'requests': [
+                {'method': 'GET', 'path': '/actors?page=1'},
+                {'method': 'GET', 'path': '/movies?page=1'}
+            ]
+        }
+        res = self.client().post('/batch', json=json_batch, headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([sub['status'] for sub in data['responses']], [200, 200])
+        self.assertTrue(len(data['responses'][0]['body']['actors']) > 0)
+
+    def test_batch_checks_permission_per_request(self):
+        json_batch = {
+            'requests': [
+                {'method': 'GET', 'path': '/actors?page=1'},
+                {'method': 'DELETE', 'path': '/actors/1'}
+            ]
+        }
+        res = self.client().post('/batch', json=json_batch, headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['responses'][0]['status'], 200)
+        self.assertEqual(data['responses'][1]['status'], 401)
+        self.assertEqual(data['responses'][1]['body']['message'], 'Permission not found.')
+
+    def test_batch_failed_request_keeps_earlier_writes(self):
+        json_batch = {
+            'requests': [
+                {'method': 'POST', 'path': '/actors', 'body': {'name': 'John', 'age': 23}},
+                {'method': 'DELETE', 'path': '/actors/1234567890'}
+            ]
+        }
+        res = self.client().post('/batch', json=json_batch, headers=casting_director_auth_header)
+        data = json.loads(res.data)
+        actor_id = data['responses'][0]['body']['created']
+
+        self.assertEqual([sub['status'] for sub in data['responses']], [200, 404])
+        res = self.client().get('/actors/{}'.format(actor_id), headers=casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 200)
+
+    def test_error_422_batch_item_with_invalid_method_or_headers(self):
+        json_batch = {
+            'requests': [
+                {'method': 7, 'path': '/actors?page=1'},
+                {'method': 'GET', 'path': '/actors?page=1', 'headers': ['Accept']},
+                {'method': 'GET', 'path': '/movies?page=1'}
+            ]
+        }
+        res = self.client().post('/batch', json=json_batch, headers=local_signer.header(['read:movies']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([sub['status'] for sub in data['responses']][:2], [422, 422])
+        self.assertFalse(data['responses'][0]['body']['success'])
+
+    def test_error_401_batch(self):
+        res = self.client().post('/batch', json={'requests': []})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Authorization header is expected.')
+
+    # ----------------------------------------------------------------------------#
+    # Tests for /export POST
+    # ----------------------------------------------------------------------------#
+
+    def test_export_actors_csv(self):
+        res = self.client().post('/export/actors', headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertTrue(res.headers['Location'].endswith('/jobs/{}'.format(data['job']['id'])))
+        self.assertEqual(data['job']['kind'], 'export')
+        self.assertEqual(data['job']['params']['tables'], ['actors'])
+        self.assertEqual(data['job']['params']['format'], 'csv')
+
+    def test_export_leaves_out_counters_and_tombstones(self):
+        columns = {name: ','.join(column_names(table)) for name, table in EXPORT_TABLES.items()}
+
+        self.assertEqual(columns, {
+            'actors': 'id,name,gender,age',
+            'movies': 'id,title,release_date',
+            'performances': 'Movie_id,Actor_id,actor_fee'
+        })
+
+    def test_error_404_export_unknown_table(self):
+        res = self.client().post('/export/unknown', headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    # ----------------------------------------------------------------------------#
+    # Tests for /jobs
+    # ----------------------------------------------------------------------------#
+
+    def test_create_and_get_job(self):
+        res = self.client().post('/jobs', json={'kind': 'reconcile'}, headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'queued')
+
+        res = self.client().get('/jobs/{}'.format(data['job']['id']), headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['job']['kind'], 'reconcile')
+
+    def test_error_403_create_purge_job(self):
+        res = self.client().post('/jobs', json={'kind': 'purge'}, headers=casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Permission not found.')
+
+    def test_error_422_create_unknown_job(self):
+        res = self.client().post('/jobs', json={'kind': 'unknown'}, headers=executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    # ----------------------------------------------------------------------------#
+    # Tests for response compression
+    # ----------------------------------------------------------------------------#
+
+    def test_gzip_large_response(self):
+        headers = dict(casting_assistant_auth_header, **{'Accept-Encoding': 'gzip'})
+        res = self.client().get('/changes?limit=1000', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('Content-Encoding'), 'gzip')
+        self.assertTrue(json.loads(gzip.decompress(res.data))['success'])
+
+    def test_small_response_not_compressed(self):
+        res = self.client().get('/', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+
+    # ----------------------------------------------------------------------------#
+    # Tests for rate limits and admission control
+    # ----------------------------------------------------------------------------#
+
+    def test_error_429_drained_bucket(self):
+        rate, burst = ratelimit.limiter.budgets['list']
+        headers = local_signer.header(['read:actors', 'read:movies'])
+
+        statuses = [self.client().get('/changes?limit=1', headers=headers).status_code
+                    for _ in range(int(burst))]
+        res = self.client().get('/changes?limit=1', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(set(statuses), {200})
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+    def test_error_503_inflight_cap_reached(self):
+        limit = ratelimit.inflight.limit
+        ratelimit.inflight.limit = 1
+        slot = ratelimit.inflight.acquire()
+
+        try:
+            res = self.client().get('/changes?limit=1', headers=casting_assistant_auth_header)
+        finally:
+            ratelimit.inflight.release(slot)
+            ratelimit.inflight.limit = limit
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertFalse(data['success'])
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+
+# ---------------------------------------------------------------------------- #
+# Token Verification 														   #
+# ---------------------------------------------------------------------------- #
+
+class AuthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.jwks_file = os.path.join(self.directory, 'jwks.json')
+
+        self.first = LocalSigner('https://first.test/', 'first-api', 'first')
+        self.second = LocalSigner('https://second.test/', ['second-api', 'other-api'], 'second')
+        self.mtime = time.time()
+        self.write_jwks(self.first.jwks())
+
+        self.issuers = dict(auth.issuers)
+        auth.issuers.update({
+            self.first.issuer: auth.Issuer(self.first.issuer, self.first.audience,
+                                           auth.FileKeySet(self.jwks_file, reload_seconds=0), ['RS256']),
+            self.second.issuer: auth.Issuer(self.second.issuer, self.second.audience,
+                                            auth.StaticKeySet(self.second.jwks()), ['RS256'])
+        })
+
+        self.client = create_app().test_client
+
+    def tearDown(self):
+        auth.issuers.clear()
+        auth.issuers.update(self.issuers)
+        shutil.rmtree(self.directory)
+
+    def write_jwks(self, document):
+        with open(self.jwks_file, 'w') as out:
+            out.write(document if isinstance(document, str) else json.dumps(document))
+
+        # Every write gets a later mtime, even where mtimes have a coarse resolution.
+        self.mtime += 10
+        os.utime(self.jwks_file, (self.mtime, self.mtime))
+
+    def assert_rejected(self, token, status_code=401):
+        with self.assertRaises(auth.AuthError) as raised:
+            auth.verify_decode_jwt(token)
+
+        self.assertEqual(raised.exception.status_code, status_code)
+
+    def test_issuer_selected_by_iss(self):
+        first = auth.verify_decode_jwt(self.first.token(['read:actors'], sub='first-user'))
+        second = auth.verify_decode_jwt(self.second.token(['read:actors'], sub='second-user', aud='other-api'))
+
+        self.assertEqual(first['sub'], 'first-user')
+        self.assertEqual(second['sub'], 'second-user')
+        # Signed by the second issuer's key, but claiming to be the first.
+        self.assert_rejected(self.second.token(['read:actors'], iss=self.first.issuer), 400)
+
+    def test_error_401_unknown_issuer(self):
+        token = self.first.token(['read:metrics'], iss='https://unknown.test/')
+
+        self.assert_rejected(token)
+        self.assertEqual(self.client().get('/metrics', headers={'Authorization': 'Bearer ' + token}).status_code,
+                         401)
+
+    def test_error_401_audience_mismatch(self):
+        token = self.first.token(['read:metrics'], aud='second-api')
+
+        self.assert_rejected(token)
+        self.assertEqual(self.client().get('/metrics', headers={'Authorization': 'Bearer ' + token}).status_code,
+                         401)
+        self.assertEqual(self.client().get('/metrics', headers=self.first.header(['read:metrics'])).status_code,
+                         200)
+
+    def test_jwks_file_reloaded_when_changed(self):
+        rotated = LocalSigner(self.first.issuer, self.first.audience, 'rotated')
+
+        self.assert_rejected(rotated.token(['read:actors']), 400)
+
+        self.write_jwks({'keys': [self.first.jwk, rotated.jwk]})
+
+        self.assertIn('sub', auth.verify_decode_jwt(rotated.token(['read:actors'])))
+        self.assertIn('sub', auth.verify_decode_jwt(self.first.token(['read:actors'])))
+
+    def test_broken_jwks_file_keeps_previous_keys(self):
+        self.write_jwks('{"keys": [')
+
+        self.assertIn('sub', auth.verify_decode_jwt(self.first.token(['read:actors'])))
+
+
+# ---------------------------------------------------------------------------- #
+# Shared Cache 																   #
+# ---------------------------------------------------------------------------- #
+
+class SharedCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.now = [1000.0]
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def clock(self):
+        return self.now[0]
+
+    def slow_produce(self):
+        with self.calls_lock:
+            self.calls += 1
+        time.sleep(0.2)
+        return {'keys': ['a']}
+
+    def assert_single_flight(self, first, second):
+        results = []
+        threads = [threading.Thread(target=lambda cache=cache: results.append(
+            cache.get_or_refresh('jwks', self.slow_produce, 60))) for cache in (first, second)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'keys': ['a']}] * 2)
+        self.assertEqual(sum(cache.refreshes for cache in {first, second}), 1)
+        self.assertEqual(sum(cache.waits for cache in {first, second}), 1)
+
+    def test_single_flight_memory(self):
+        cache = sharedcache.SharedCache(sharedcache.MemoryStore())
+
+        self.assert_single_flight(cache, cache)
+
+    def test_single_flight_across_sqlite_workers(self):
+        # Two caches on one file stand for two worker processes.
+        self.assert_single_flight(sharedcache.SharedCache(sharedcache.SQLiteStore(self.path)),
+                                  sharedcache.SharedCache(sharedcache.SQLiteStore(self.path)))
+
+    def test_waiter_produces_after_lock_seconds(self):
+        store = sharedcache.SQLiteStore(self.path)
+        cache = sharedcache.SharedCache(store, lock_seconds=0.2, poll_seconds=0.01)
+
+        # A worker took the refresh lock and died without producing.
+        self.assertTrue(store.acquire('lock:jwks', 60))
+
+        start = time.monotonic()
+        value = cache.get_or_refresh('jwks', self.slow_produce, 60)
+
+        self.assertEqual(value, {'keys': ['a']})
+        self.assertEqual((self.calls, cache.waits, cache.refreshes), (1, 1, 0))
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_memory_entries_expire(self):
+        cache = sharedcache.SharedCache(sharedcache.MemoryStore(clock=self.clock))
+        cache.set('key', 'value', 10)
+
+        self.now[0] += 9
+        self.assertEqual(cache.get('key'), 'value')
+        self.now[0] += 2
+        self.assertIsNone(cache.get('key'))
+
+    def test_sqlite_entries_expire(self):
+        cache = sharedcache.SharedCache(sharedcache.SQLiteStore(self.path))
+        cache.set('key', 'value', 0.1)
+
+        self.assertEqual(cache.get('key'), 'value')
+        time.sleep(0.15)
+        self.assertIsNone(cache.get('key'))
+
+    def test_token_payload_not_cached_past_exp(self):
+        cache = sharedcache.SharedCache(sharedcache.MemoryStore(clock=self.clock))
+        auth_cache, auth.auth_cache = auth.auth_cache, cache
+        local_signer.register()
+
+        try:
+            token = local_signer.token(['read:actors'], exp=int(time.time()) + 5)
+            auth.verify_decode_jwt(token)
+        finally:
+            auth.auth_cache = auth_cache
+            local_signer.unregister()
+
+        token_key = 'token:' + hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+        self.assertLess(5, auth.TOKEN_CACHE_TTL)
+        self.assertIsNotNone(cache.get(token_key))
+        self.now[0] += 5
+        self.assertIsNone(cache.get(token_key))
+
+
+# ---------------------------------------------------------------------------- #
+# SQLite Database 															   #
+# ---------------------------------------------------------------------------- #
+
+class SQLiteTestCase(unittest.TestCase):
+    '''Runs against a fresh SQLite database in a temporary directory.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app()
+        self.client = self.app.test_client
+
+        setup_db(self.app, 'sqlite:///' + os.path.join(self.directory, 'test.db'))
+
+        self.context = self.app.app_context()
+        self.context.push()
+        create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, text):
+        path = os.path.join(self.directory, name)
+        opener = gzip.open if name.endswith('.gz') else open
+
+        with opener(path, 'wt') as out:
+            out.write(text)
+
+        return path
+
+
+# ---------------------------------------------------------------------------- #
+# Rate Limiting 															   #
+# ---------------------------------------------------------------------------- #
+
+class MemoryBackendTestCase(unittest.TestCase):
+
+    def test_full_buckets_are_dropped(self):
+        backend = ratelimit.MemoryBackend()
+        backend.SWEEP_EVERY = 3
+
+        self.assertEqual(backend.take('idle', 1000, 1), 0)
+        self.assertEqual(backend.take('busy', 0.001, 2), 0)
+        time.sleep(0.01)
+        self.assertEqual(backend.take('busy', 0.001, 2), 0)
+
+        # idle refilled within a millisecond, busy is empty for a long time.
+        self.assertEqual(set(backend._buckets), {'busy'})
+        self.assertGreater(backend.take('busy', 0.001, 2), 0)
+
+
+# ---------------------------------------------------------------------------- #
+# Admission Control 														   #
+# ---------------------------------------------------------------------------- #
+
+class InflightSlotsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'inflight.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sqlite_cap_is_shared_by_workers(self):
+        # Two limiters on one file stand for two worker processes.
+        first = ratelimit.InflightLimiter(2, ratelimit.SQLiteSlots(self.path))
+        second = ratelimit.InflightLimiter(2, ratelimit.SQLiteSlots(self.path))
+
+        slots = [first.acquire(), second.acquire()]
+
+        self.assertNotIn(None, slots)
+        self.assertIsNone(first.acquire())
+        self.assertIsNone(second.acquire())
+        self.assertEqual(second.stats(), {'limit': 2, 'inflight': 2, 'shed': 1})
+
+        first.release(slots[1])
+
+        self.assertIsNotNone(second.acquire())
+
+    def test_sqlite_reclaims_stale_slots(self):
+        slots = ratelimit.SQLiteSlots(self.path, stale_seconds=0.05)
+
+        self.assertIsNotNone(slots.acquire(1))
+        self.assertIsNone(slots.acquire(1))
+        time.sleep(0.1)
+        self.assertIsNotNone(slots.acquire(1))
+
+
+# ---------------------------------------------------------------------------- #
+# Bulk Import 																   #
+# ---------------------------------------------------------------------------- #
+
+class BulkImportTestCase(SQLiteTestCase):
+
+    def load(self, **files):
+        return bulk_import(batch_size=2, report=lambda message: None, **files)
+
+    def test_import_csv_and_ndjson(self):
+        actors = self.write_file('actors.csv', 'name,age,gender\n'
+                                               'Ann,30,Female\n'
+                                               'Bob,41,\n'
+                                               'Cid,x,Male\n'
+                                               ',25,Male\n'
+                                               'Dee,52,Female\n')
+        movies = self.write_file('movies.ndjson.gz', '{"title": "Up", "release_date": "2020-01-31"}\n'
+                                                     '{"title": "Down", "release_date": "2021-02-28"}\n'
+                                                     '\n'
+                                                     '{"title": "Sideways", "release_date": "soon"}\n')
+
+        results = self.load(actors=actors, movies=movies)
+
+        self.assertEqual(results, {'actors': (3, 2), 'movies': (2, 1)})
+        self.assertEqual(sorted(actor.name for actor in Actor.query), ['Ann', 'Bob', 'Dee'])
+        self.assertEqual(Actor.query.filter_by(name='Bob').one().gender, 'Other')
+        self.assertEqual(Movie.query.filter_by(title='Down').one().release_date, date(2021, 2, 28))
+
+    def test_import_performances_by_id_and_name(self):
+        self.load(actors=self.write_file('actors.csv', 'name,age\nAnn,30\nBob,41\nBob,42\n'),
+                  movies=self.write_file('movies.csv', 'title,release_date\nUp,2020-01-31\nDown,2021-02-28\n'))
+        ann = Actor.query.filter_by(name='Ann').one()
+        bob = Actor.query.filter_by(name='Bob').first()
+        up = Movie.query.filter_by(title='Up').one()
+        down = Movie.query.filter_by(title='Down').one()
+
+        performances = self.write_file('performances.csv', 'movie_id,movie_title,actor_id,actor_name,actor_fee\n'
+                                       '{up},,,Ann,10\n'
+                                       ',Down,{bob},,\n'
+                                       ',Up,,Bob,5\n'
+                                       ',Nope,,Ann,5\n'
+                                       '{up},,12345,,5\n'
+                                       ',Down,{bob},,7\n'
+                                       ',Down,,Ann,2.5\n'.format(up=up.id, bob=bob.id))
+
+        results = self.load(performances=performances)
+        db.session.expire_all()
+
+        # Bob is ambiguous, Nope and 12345 are unknown, Bob in Down is cast twice.
+        self.assertEqual(results, {'performances': (3, 4)})
+        self.assertEqual((up.cast_count, up.total_fee), (1, 10.0))
+        self.assertEqual((down.cast_count, down.total_fee), (2, 2.5))
+        self.assertEqual(ann.movie_count, 2)
+
+    def test_failed_file_leaves_nothing_behind(self):
+        movies = self.write_file('movies.ndjson', '{"title": "Up", "release_date": "2020-01-31"}\n'
+                                                  '{"title": "Down", "release_date": "2021-02-28"}\n'
+                                                  '{"title": "Sideways", "release_date": "2022-03-31"}\n'
+                                                  'not json\n')
+
+        with self.assertRaises(ValueError):
+            self.load(movies=movies)
+
+        self.assertEqual(Movie.query.count(), 0)
+
+
+# ---------------------------------------------------------------------------- #
+# Denormalized Counters 													   #
+# ---------------------------------------------------------------------------- #
+
+class CountersTestCase(SQLiteTestCase):
+
+    def setUp(self):
+        super(CountersTestCase, self).setUp()
+        local_signer.register()
+        self.headers = local_signer.header(['create:actors', 'create:movies', 'edit:movies',
+                                            'delete:actors', 'delete:movies'])
+
+    def tearDown(self):
+        local_signer.unregister()
+        super(CountersTestCase, self).tearDown()
+
+    def create(self, path, record):
+        return json.loads(self.client().post(path, json=record, headers=self.headers).data)['created']
+
+    def test_deleting_both_sides_leaves_nothing_to_reconcile(self):
+        actor_id = self.create('/actors', {'name': 'Ann', 'age': 30})
+        movie_ids = [self.create('/movies', {'title': title, 'release_date': '2020-01-31'}) for title in 'AB']
+
+        for movie_id in movie_ids:
+            self.client().post('/movies/{}/actors'.format(movie_id),
+                               json={'actors': [{'id': actor_id, 'actor_fee': 10.0}]}, headers=self.headers)
+
+        self.client().delete('/actors/{}'.format(actor_id), headers=self.headers)
+        self.client().delete('/movies/{}'.format(movie_ids[0]), headers=self.headers)
+
+        self.assertEqual(reconcile_counters(), (0, 0))
+
+
+# ---------------------------------------------------------------------------- #
+# Background Jobs 															   #
+# ---------------------------------------------------------------------------- #
+
+class JobsTestCase(SQLiteTestCase):
+
+    def setUp(self):
+        super(JobsTestCase, self).setUp()
+        local_signer.register()
+
+    def tearDown(self):
+        local_signer.unregister()
+        super(JobsTestCase, self).tearDown()
+
+    def run_jobs(self):
+        run_worker(self.app, 1, burst=True)
+
+    def get_job(self, job_id, headers):
+        res = self.client().get('/jobs/{}'.format(job_id), headers=headers)
+        return json.loads(res.data)['job']
+
+    def test_export_file_is_served_from_the_database(self):
+        headers = local_signer.header(['read:actors', 'read:movies'])
+        db.session.add_all([Actor(name='Ann', age=30, gender='Female'), Actor(name='Bob', age=41, gender='Male')])
+        db.session.commit()
+
+        res = self.client().post('/export/actors', headers=headers)
+        job_id = json.loads(res.data)['job']['id']
+        self.run_jobs()
+        job = self.get_job(job_id, headers)
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result']['files'], [{'table': 'actors', 'file': 'actors.csv.gz', 'rows': 2}])
+
+        res = self.client().get('/jobs/{}/files/actors.csv.gz'.format(job_id), headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(gzip.decompress(res.data).decode().splitlines(),
+                         ['id,name,gender,age', '1,Ann,Female,30', '2,Bob,Male,41'])
+
+        # Finished jobs expire with their files.
+        self.assertEqual(expire_jobs(older_than_hours=0), 1)
+        self.assertEqual(JobFile.query.count(), 0)
+        self.assertEqual(self.client().get('/jobs/{}'.format(job_id), headers=headers).status_code, 404)
+
+    def test_import_job_reads_uploaded_files(self):
+        headers = local_signer.header(['read:movies', 'create:actors', 'create:movies', 'edit:movies'])
+        actors = gzip.compress(b'name,age,gender\nAnn,30,Female\nBob,x,Male\n')
+
+        res = self.client().post('/jobs', headers=headers, content_type='multipart/form-data', data={
+            'kind': 'import',
+            'params': json.dumps({'batch_size': 10}),
+            'actors': (io.BytesIO(actors), 'people.csv.gz')
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['params']['actors'], 'actors.csv.gz')
+
+        self.run_jobs()
+        job = self.get_job(data['job']['id'], headers)
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result'], {'actors': {'rows': 1, 'rejected': 1}})
+        self.assertEqual([actor.name for actor in Actor.query], ['Ann'])
+        # The upload is deleted once the job has finished.
+        self.assertEqual(JobFile.query.count(), 0)
+
+    def test_retried_export_replays_the_queued_job(self):
+        headers = dict(local_signer.header(['read:actors', 'read:movies']), **{'Idempotency-Key': str(uuid.uuid4())})
+
+        first = self.client().post('/export/movies', headers=headers)
+        retry = self.client().post('/export/movies', headers=headers)
+
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(retry.headers['Location'], first.headers['Location'])
+        self.assertEqual(json.loads(retry.data)['job']['id'], json.loads(first.data)['job']['id'])
+        self.assertEqual(self.client().get('/export/movies', headers=headers).status_code, 405)
+
+    def test_import_marks_its_job_alive_between_batches(self):
+        stale = datetime.utcnow() - timedelta(hours=1)
+        job = Job(kind='import', params='{}', status='running', heartbeat_at=stale)
+        db.session.add(job)
+        db.session.commit()
+
+        progress = JobProgress(job.id)
+        progress.beat_every = timedelta(0)
+        bulk_import(actors=self.write_file('actors.csv', 'name,age\nAnn,30\nBob,41\n'), batch_size=1,
+                    report=progress, on_batch=progress.beat)
+        db.session.expire_all()
+
+        self.assertGreater(Job.query.get(job.id).heartbeat_at, stale)
+
+    def test_error_422_import_job_without_upload(self):
+        headers = local_signer.header(['read:movies', 'create:actors', 'create:movies', 'edit:movies'])
+
+        res = self.client().post('/jobs', headers=headers,
+                                 json={'kind': 'import', 'params': {'actors': 'actors.csv'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_error_422_file_for_job_without_inputs(self):
+        headers = local_signer.header(['read:movies', 'edit:actors', 'edit:movies'])
+
+        res = self.client().post('/jobs', headers=headers, content_type='multipart/form-data', data={
+            'kind': 'reconcile',
+            'actors': (io.BytesIO(b'name\nAnn\n'), 'actors.csv')
+        })
+
+        self.assertEqual(res.status_code, 422)
+
+
+# ---------------------------------------------------------------------------- #
+# Statement Timeouts 														   #
+# ---------------------------------------------------------------------------- #
+
+class StatementTimeoutTestCase(SQLiteTestCase):
+
+    # Counts to 10^8 unless interrupted: many seconds on SQLite.
+    SLOW_QUERY = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000) ' \
+                 'SELECT count(*) FROM c'
+
+    def setUp(self):
+        super(StatementTimeoutTestCase, self).setUp()
+
+        @self.app.route('/test/slow')
+        def slow_query():
+            return jsonify({'count': db.session.execute(self.SLOW_QUERY).scalar()})
+
+        @self.app.route('/test/broken')
+        def broken_query():
+            return jsonify({'count': db.session.execute('SELECT count(*) FROM no_such_table').scalar()})
+
+        timeouts.STATEMENT_TIMEOUTS['slow_query'] = 50
+
+    def tearDown(self):
+        timeouts.STATEMENT_TIMEOUTS.pop('slow_query', None)
+        super(StatementTimeoutTestCase, self).tearDown()
+
+    def test_error_503_statement_timeout(self):
+        start = time.monotonic()
+        res = self.client().get('/test/slow')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(data['message'], 'database query timed out')
+        self.assertLess(time.monotonic() - start, 5)
+        # The interrupted connection went back to the pool in a usable state.
+        self.assertEqual(self.client().get('/').status_code, 200)
+        self.assertEqual(db.session.execute('SELECT 1').scalar(), 1)
+
+    def test_error_500_other_database_errors(self):
+        res = self.client().get('/test/broken')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 500)
+        self.assertFalse(data['success'])
+
+
+# ---------------------------------------------------------------------------- #
+# Startup 																	   #
+# ---------------------------------------------------------------------------- #
+
+class StartupTestCase(unittest.TestCase):
+
+    def test_import_does_not_build_app(self):
+        import app as app_module
+
+        self.assertNotIn('app', vars(app_module))
+
+    def test_create_app_serves_without_schema_setup(self):
+        res = create_app().test_client().get('/')
+
+        self.assertEqual(res.status_code, 200)
+
 
 if __name__ == "__main__":
     unittest.main()
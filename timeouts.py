@@ -0,0 +1,100 @@
+import sqlite3
+import time
+from flask import (
+    g,
+    has_request_context
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from models import db
+from config import (
+    STATEMENT_TIMEOUT_MS,
+    STATEMENT_TIMEOUTS
+)
+
+# ---------------------------------------------------------------------------- #
+# Statement Timeouts                                                           #
+# ---------------------------------------------------------------------------- #
+
+'''
+Per-route statement timeouts
+    A before_request hook stores the timeout of the matched endpoint
+    (STATEMENT_TIMEOUTS, falling back to STATEMENT_TIMEOUT_MS; 0 means none)
+    on g. Every statement issued while handling the request is then bounded:
+
+    Postgres  `SET LOCAL statement_timeout` at the start of each session
+              transaction; the server cancels the statement (SQLSTATE 57014).
+    SQLite    a progress handler installed on every new connection interrupts
+              the statement once the per-statement deadline has passed.
+
+    A cancelled statement surfaces as sqlalchemy.exc.OperationalError;
+    create_app's handler rolls the session back, which returns the
+    connection to the pool, and answers 503.
+
+    Code running outside a request (manage.py commands, job workers) is not
+    limited.
+'''
+
+SQLITE_PROGRESS_STEPS = 1000
+
+
+def timeout_for(endpoint):
+    return STATEMENT_TIMEOUTS.get(endpoint, STATEMENT_TIMEOUT_MS)
+
+
+def current_timeout_ms():
+    if not has_request_context():
+        return 0
+    return g.get('statement_timeout_ms', 0)
+
+
+def is_statement_timeout(error):
+    orig = getattr(error, 'orig', None)
+
+    if getattr(orig, 'pgcode', None) == '57014':
+        return True
+
+    return isinstance(orig, sqlite3.OperationalError) and 'interrupted' in str(orig)
+
+
+@event.listens_for(db.session, 'after_begin')
+def set_postgres_statement_timeout(session, transaction, connection):
+    timeout_ms = current_timeout_ms()
+
+    if timeout_ms and connection.dialect.name == 'postgresql':
+        # SET does not take bind parameters; timeout_ms is an int from config.
+        connection.execute('SET LOCAL statement_timeout = {:d}'.format(int(timeout_ms)))
+
+
+@event.listens_for(Pool, 'connect')
+def install_sqlite_progress_handler(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    deadline = connection_record.info['statement_deadline'] = [None]
+
+    def interrupt_when_late():
+        return deadline[0] is not None and time.monotonic() > deadline[0]
+
+    dbapi_connection.set_progress_handler(interrupt_when_late, SQLITE_PROGRESS_STEPS)
+
+
+@event.listens_for(Pool, 'checkin')
+def clear_sqlite_statement_deadline(dbapi_connection, connection_record):
+    deadline = connection_record.info.get('statement_deadline') if connection_record else None
+
+    if deadline is not None:
+        deadline[0] = None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_sqlite_statement_deadline(conn, cursor, statement, parameters, context, executemany):
+    # The deadline is left running after execute() returns, because SQLite
+    # does most of a query's work while rows are fetched; it is cleared when
+    # the connection goes back to the pool.
+    deadline = conn.info.get('statement_deadline')
+
+    if deadline is not None:
+        timeout_ms = current_timeout_ms()
+        deadline[0] = time.monotonic() + timeout_ms / 1000.0 if timeout_ms else None